@@ -1,50 +1,76 @@
-import datetime
-
 from django.contrib import admin
 from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.admin.views.main import ChangeList
 from django.conf.urls import url
+from django.db import transaction
 from django.http import JsonResponse
 
 
-from openedx.features.edx_enterprise_api import views
 from openedx.features.edx_enterprise_api.models import (
     EdxOrgCourse,
+    EdxOrgIndexOperation,
+    EdxOrgSyncRun,
 )
 
 
+class EdxOrgCoursesChangeList(ChangeList):
+    """Load only listed columns, leaving course_details_json and description text columns unread"""
+
+    def get_queryset(self, request):
+        return super(EdxOrgCoursesChangeList, self).get_queryset(request).only(
+            'id', 'site', 'course_id', 'course_title', 'is_edx', 'is_active')
+
+
 class EdxOrgCoursesAdmin(admin.ModelAdmin):
-    list_display = ('course_id', 'course_title', 'is_edx', 'is_active')
-    list_filter = ('is_edx', 'is_active',)
+    list_display = ('course_id', 'site', 'course_title', 'is_edx', 'is_active')
+    list_filter = ('site', 'is_edx', 'is_active',)
     search_fields = ('course_id', 'course_title',)
+    # skip the unfiltered COUNT(*) over every archived row on each changelist page
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return EdxOrgCoursesChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        """Look up course ids ('course:org+number') and course keys ('org+number') by indexed course_id prefix
+
+        Course keys are looked up as 'course:' + key, which is how edx.org course ids start. The prefix
+        lookup is served by the course_id index on MySQL, whose default collations make LIKE case insensitive.
+        Other terms fall back to the icontains search over course_id and course_title.
+        """
+        search_term = search_term.strip()
+        if '+' in search_term and ' ' not in search_term and not search_term.startswith('course:'):
+            search_term = 'course:' + search_term
+        if search_term.startswith('course:'):
+            return queryset.filter(course_id__istartswith=search_term), False
+        return super(EdxOrgCoursesAdmin, self).get_search_results(request, queryset, search_term)
 
     def save_model(self, request, obj, form, change):
-        """if course is not active it removes from ElasticSearch else Save to table and reindex into ElasticSearch"""
-        default_date = '2017-01-01T00:00:00+00:00'
-        if not obj.is_active:
-            views.delete_edxorg_courses_from_search(obj.course_id)
-        else:
-            course_info = {
-                'id': obj.course_id,
-                'course': obj.course_id,
-                'content': {
-                    'number': obj.course_number,
-                    'display_name': obj.course_title},
-                'org': 'edX Courses',
-                'is_edx': True,
-                'image_url': obj.course_image if obj.course_image else None,
-                'start': datetime.datetime.strptime(
-                    "2017-01-01",
-                    '%Y-%m-%d').strftime('%b %d, %Y'),
-                'enrollment_start': default_date,
-            }
-            reindex_edxorg_courses(course_info)
-        return super(
-            EdxOrgCoursesAdmin,
-            self).save_model(
-            request,
-            obj,
-            form,
-            change)
+        """Save to table and queue reindex into ElasticSearch, or removal if course is not active
+
+        The index worker applies the change in the background, so the admin request does not wait on ElasticSearch.
+        """
+        with transaction.atomic():
+            super(
+                EdxOrgCoursesAdmin,
+                self).save_model(
+                request,
+                obj,
+                form,
+                change)
+            EdxOrgIndexOperation.objects.enqueue(
+                EdxOrgIndexOperation.ACTION_INDEX if obj.is_active else EdxOrgIndexOperation.ACTION_DELETE,
+                [obj.course_id],
+                site=obj.site)
+        EdxOrgCourse.cache_about_records([obj])
+
+
+class EdxOrgSyncRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'site', 'created', 'finished', 'status', 'incremental')
+    list_filter = ('site', 'status',)
+    exclude = ('processed_course_ids',)
+    readonly_fields = ('site', 'status', 'incremental', 'catalog_checkpoints', 'error', 'finished')
 
 
 admin.site.register(EdxOrgCourse, EdxOrgCoursesAdmin)
+admin.site.register(EdxOrgSyncRun, EdxOrgSyncRunAdmin)
@@ -0,0 +1,242 @@
+import email.utils
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+from django.core.cache import cache
+
+from openedx.features.edx_enterprise_api.instrumentation import SyncMetrics
+from openedx.features.edx_enterprise_api.sites import DEFAULT_SITE, get_site_setting
+
+log = logging.getLogger(__name__)
+
+ACCESS_TOKEN_CACHE_KEY = 'edx_enterprise_api.access_token_detail'
+
+# refresh access token this many seconds before edx.org expires it
+ACCESS_TOKEN_EXPIRY_MARGIN = 60
+
+# responses worth retrying; 429 and 503 also mean the API is throttling us
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+THROTTLE_STATUS_CODES = (429, 503)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """Return process wide keep-alive requests.Session shared by edx.org API and ElasticSearch calls"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = getattr(settings, 'EDX_ENTERPRISE_HTTP_POOL_SIZE', 10)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def get_access_token_cache_key(site=DEFAULT_SITE):
+    """Cache key of the access token of site's enterprise credentials"""
+    return '{}.{}'.format(ACCESS_TOKEN_CACHE_KEY, site) if site else ACCESS_TOKEN_CACHE_KEY
+
+
+def get_retry_after(response):
+    """Return seconds to wait from Retry-After header (delta seconds or HTTP date), None if absent"""
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    retry_date = email.utils.parsedate_tz(retry_after)
+    if retry_date is None:
+        return None
+    return max(email.utils.mktime_tz(retry_date) - time.time(), 0)
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """ Limit concurrent API calls, halving the limit when throttled and growing it back while healthy.
+
+        Additive increase: the limit grows by one after 'limit' successful calls in a row.
+        Multiplicative decrease: a throttled call halves it, down to minimum.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = max(maximum, 1)
+        self.minimum = max(min(minimum, self.maximum), 1)
+        self.limit = self.maximum
+        self.active = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.active -= 1
+            if throttled:
+                self._successes = 0
+                new_limit = max(self.limit // 2, self.minimum)
+                if new_limit < self.limit:
+                    log.warning("edx.org API is throttling, lowering concurrency to %s", new_limit)
+                self.limit = new_limit
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.maximum:
+                    self._successes = 0
+                    self.limit += 1
+            self._condition.notify_all()
+
+
+class EnterpriseApiClient(object):
+    """ Call edx.org enterprise API over a pooled session with a cached access token.
+
+        Access token detail is kept in memory and in django cache until shortly
+        before 'expires_in'. A request answered with 401 refreshes the token once and is retried.
+        Credentials are those of site (see sites.get_site_setting), each site caching its own token.
+
+        Connection errors, 429 and 5xx answers are retried with exponential backoff and jitter,
+        honouring Retry-After, and concurrent calls go through an AdaptiveConcurrencyLimiter.
+    """
+
+    def __init__(self, session=None, metrics=None, site=DEFAULT_SITE):
+        self.site = site
+        self.token_cache_key = get_access_token_cache_key(site)
+        self.session = session or get_http_session()
+        self.metrics = metrics or SyncMetrics()
+        self.max_retries = getattr(settings, 'EDX_ENTERPRISE_API_MAX_RETRIES', 5)
+        self.backoff_base = getattr(settings, 'EDX_ENTERPRISE_API_BACKOFF_BASE', 0.5)
+        self.backoff_max = getattr(settings, 'EDX_ENTERPRISE_API_BACKOFF_MAX', 60)
+        self.timeout = getattr(settings, 'EDX_ENTERPRISE_API_TIMEOUT', 30)
+        self.limiter = AdaptiveConcurrencyLimiter(
+            getattr(settings, 'EDX_ENTERPRISE_API_MAX_CONCURRENCY', 16))
+        self._token_detail = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
+
+    def fetch_access_token_detail(self):
+        """ Call EDX_ENTERPRISE_ACCESS_TOKEN_API using credentials and return parsed access token detail
+
+                reponse = {
+                        u'token_type': u'JWT',
+                        u'access_token': u'encrypted access token',
+                        u'expires_in': 3600, u'scope': u'read write profile email'
+                }
+        """
+        data = {
+            'grant_type': "client_credentials",
+            'client_id': get_site_setting(self.site, 'EDX_ENTERPRISE_API_CLIENT_ID'),
+            'client_secret': get_site_setting(self.site, 'EDX_ENTERPRISE_API_CLIENT_SECRET'),
+            'token_type': "jwt"
+        }
+        with self.metrics.timer('token_fetch'):
+            response = self.send("POST", get_site_setting(self.site, 'EDX_ENTERPRISE_ACCESS_TOKEN_API'), data=data)
+            response.raise_for_status()
+        self.metrics.increment('bytes_downloaded', len(response.content))
+        return response.json()
+
+    def get_access_token_detail(self, stale_token_detail=None):
+        """ Return cached access token detail, fetching a new one if missing or expired.
+
+            stale_token_detail is the token a request was rejected with; it is only
+            replaced once even if several threads report it at the same time.
+        """
+        with self._token_lock:
+            if stale_token_detail is not None:
+                if self._token_detail == stale_token_detail:
+                    self._token_detail = None
+                    cache.delete(self.token_cache_key)
+
+            if self._token_detail is not None and time.time() < self._token_expires_at:
+                return self._token_detail
+
+            token_detail, expires_at = cache.get(self.token_cache_key) or (None, 0)
+            if token_detail is None or token_detail == stale_token_detail or time.time() >= expires_at:
+                token_detail = self.fetch_access_token_detail()
+                timeout = max(int(token_detail.get('expires_in', 3600)) - ACCESS_TOKEN_EXPIRY_MARGIN, 0)
+                expires_at = time.time() + timeout
+                if timeout:
+                    cache.set(self.token_cache_key, (token_detail, expires_at), timeout)
+
+            self._token_detail = token_detail
+            self._token_expires_at = expires_at
+            return token_detail
+
+    def get_request_headers(self, token_detail):
+        """ Build authorization headers for edx.org enterprise API from access token detail"""
+        return {
+            'authorization': "{} {}".format(
+                token_detail.get('token_type'),
+                token_detail.get('access_token')),
+            'accept': "application/json",
+            'cache-control': "no-cache"}
+
+    def get_backoff_delay(self, attempt, response=None):
+        """Seconds to sleep before retry number attempt: Retry-After if sent, else capped exponential with full jitter"""
+        retry_after = get_retry_after(response) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def send(self, method, url, **kwargs):
+        """ Send request through the concurrency limiter, retrying connection errors, 429 and 5xx answers
+
+            Returns the last response once retries are exhausted; connection errors are re-raised.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            response = None
+            self.limiter.acquire()
+            self.metrics.increment('http_requests')
+            try:
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                finally:
+                    # every outcome, including errors not retried here, frees the slot exactly once
+                    self.limiter.release(
+                        throttled=response is not None and response.status_code in THROTTLE_STATUS_CODES)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                self.metrics.increment('http_connection_errors')
+                if attempt >= self.max_retries:
+                    raise
+                log.warning("edx.org API %s %s failed (%s), retrying", method, url, error)
+            else:
+                if response.status_code in THROTTLE_STATUS_CODES:
+                    self.metrics.increment('http_throttled')
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+                log.warning("edx.org API %s %s answered %s, retrying", method, url, response.status_code)
+
+            self.metrics.increment('http_retries')
+            time.sleep(self.get_backoff_delay(attempt, response))
+            attempt += 1
+
+    def request(self, method, url, **kwargs):
+        """ Make authorized request to edx.org enterprise API, refreshing access token once on 401"""
+        token_detail = self.get_access_token_detail()
+        response = self.send(
+            method, url, headers=self.get_request_headers(token_detail), **kwargs)
+
+        if response.status_code == 401:
+            token_detail = self.get_access_token_detail(stale_token_detail=token_detail)
+            response = self.send(
+                method, url, headers=self.get_request_headers(token_detail), **kwargs)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
@@ -0,0 +1,338 @@
+"""Offline benchmark of the edx.org catalog sync.
+
+StubEnterpriseApi serves synthetic access token, enterprise catalog, course list and
+course detail endpoints (plus the ElasticSearch delete-by-query endpoint and, optionally,
+course card images) from a local thread. run_sync_benchmark points EdxorgCourses at it, indexes into InMemorySearchEngine
+and reports wall time, HTTP calls, SQL queries and peak RSS.
+"""
+import hashlib
+import json
+import resource
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+from collections import Counter
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import parse_qs, urlparse
+
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from search.search_engine_base import SearchEngine
+
+CATALOG_PATH = '/enterprise/v1/enterprise-catalogs/'
+TOKEN_PATH = '/oauth2/v1/access_token'
+SEARCH_DELETE_PATH = '/courseware_index/course_info/_query'
+IMAGE_PATH = '/images/'
+
+
+def make_png(width, height, rgb):
+    """Encode a width x height PNG filled with the rgb color"""
+    def chunk(chunk_type, data):
+        return (struct.pack('>I', len(data)) + chunk_type + data +
+                struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    row = b'\x00' + bytes(bytearray(rgb)) * width
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(row * height)) +
+            chunk(b'IEND', b''))
+
+
+class InMemorySearchEngine(SearchEngine):
+    """SearchEngine stand-in keeping indexed documents in a process wide dict"""
+
+    documents = {}
+    index_calls = Counter()
+
+    def index(self, doc_type, sources, **kwargs):
+        InMemorySearchEngine.index_calls[doc_type] += 1
+        for source in sources:
+            InMemorySearchEngine.documents[(self.index_name, doc_type, source['id'])] = source
+
+    def remove(self, doc_type, doc_ids, **kwargs):
+        for doc_id in doc_ids:
+            InMemorySearchEngine.documents.pop((self.index_name, doc_type, doc_id), None)
+
+    def search(self, query_string=None, field_dictionary=None, filter_dictionary=None,
+               exclude_dictionary=None, facet_terms=None, **kwargs):
+        results = [
+            {'data': source} for (index_name, doc_type, doc_id), source in InMemorySearchEngine.documents.items()
+            if index_name == self.index_name]
+        return {'total': len(results), 'max_score': 0, 'results': results}
+
+    @classmethod
+    def reset(cls):
+        cls.documents = {}
+        cls.index_calls = Counter()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubEnterpriseApi(object):
+    """Local HTTP stand-in for the edx.org enterprise API
+
+    courses: number of courses in the catalog
+    runs: course runs per course
+    page_size: courses per catalog page
+    latency: seconds slept before answering each request
+    token_max_calls: calls an access token is valid for before it answers 401 expired, 0 for never
+    images: distinct card images shared round robin by the courses, 0 for courses without one;
+        images are served with an ETag and answer 304 to a matching If-None-Match
+    """
+
+    def __init__(self, courses=1000, runs=3, page_size=100, latency=0.0, token_max_calls=0, images=0):
+        self.courses = courses
+        self.runs = runs
+        self.page_size = page_size
+        self.latency = latency
+        self.token_max_calls = token_max_calls
+        self.images = images
+        self.catalog_uuid = str(uuid.uuid4())
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self._token_calls = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.handle(self, 'GET')
+
+            def do_POST(self):
+                stub.handle(self, 'POST')
+
+            def do_DELETE(self):
+                stub.handle(self, 'DELETE')
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def settings(self):
+        """Settings pointing EdxorgCourses and delete_edxorg_courses_from_search at this stub"""
+        port = self._server.server_address[1]
+        return {
+            'EDX_ENTERPRISE_API_CLIENT_ID': 'bench',
+            'EDX_ENTERPRISE_API_CLIENT_SECRET': 'bench',
+            'EDX_ENTERPRISE_ACCESS_TOKEN_API': self.base_url + TOKEN_PATH,
+            'EDX_ENTERPRISE_CLIENT_CATALOG_DETAIL_API': self.base_url + CATALOG_PATH,
+            'EDX_ENTERPRISE_COURSE_DETAIL_API': self.base_url + CATALOG_PATH,
+            'ELASTIC_SEARCH_CONFIG': [{'host': '127.0.0.1', 'port': port}],
+            'SEARCH_ENGINE': 'openedx.features.edx_enterprise_api.benchmark.InMemorySearchEngine',
+        }
+
+    def handle(self, request, method):
+        if self.latency:
+            time.sleep(self.latency)
+        parsed_url = urlparse(request.path)
+        path = parsed_url.path
+
+        if method == 'POST' and path == TOKEN_PATH:
+            self._count('token')
+            return self._respond(request, 200, {
+                'token_type': 'JWT', 'access_token': str(uuid.uuid4()), 'expires_in': 3600})
+
+        if method == 'DELETE' and path == SEARCH_DELETE_PATH:
+            self._count('search_delete')
+            return self._respond(request, 200, {})
+
+        if method == 'GET' and path.startswith(IMAGE_PATH):
+            return self.respond_image(request, path[len(IMAGE_PATH):])
+
+        if method != 'GET' or not path.startswith(CATALOG_PATH):
+            self._count('not_found')
+            return self._respond(request, 404, {'detail': 'Not found.'})
+
+        if not self._authorize(request):
+            self._count('unauthorized')
+            return self._respond(request, 401, {'detail': 'Signature has expired.'})
+
+        parts = [part for part in path[len(CATALOG_PATH):].split('/') if part]
+        if not parts:
+            self._count('catalogs')
+            return self._respond(request, 200, {
+                'count': 1, 'next': None, 'previous': None,
+                'results': [{'uuid': self.catalog_uuid, 'title': 'Benchmark catalog'}]})
+        if len(parts) == 1:
+            self._count('course_pages')
+            page = int(parse_qs(parsed_url.query).get('page', ['1'])[0])
+            return self._respond(request, 200, self.course_page(page))
+        self._count('course_detail')
+        return self._respond(request, 200, {
+            'key': parts[-1],
+            'course_runs': [{'marketing_url': 'https://www.edx.org/course/{}'.format(parts[-1])}]})
+
+    def course_page(self, page):
+        first = (page - 1) * self.page_size
+        last = min(first + self.page_size, self.courses)
+        next_url = None
+        if last < self.courses:
+            next_url = "{}{}{}?page={}".format(self.base_url, CATALOG_PATH, self.catalog_uuid, page + 1)
+        return {
+            'count': self.courses,
+            'next': next_url,
+            'previous': None,
+            'results': [self.course(index) for index in range(first, last)],
+        }
+
+    def course(self, index):
+        """Build synthetic edx.org course number index; same index always yields the same course"""
+        key = 'BenchX+C{}'.format(index)
+        course_runs = []
+        for run in range(self.runs):
+            year = 2018 + run
+            course_runs.append({
+                'key': 'course-v1:{}+{}'.format(key, year),
+                'start': '{}-0{}-01T00:00:00Z'.format(year, 1 + index % 9),
+                'end': '{}-12-31T23:59:00Z'.format(year),
+                'enrollment_start': None,
+                'enrollment_end': '{}-11-30T23:59:00Z'.format(year),
+                'enrollment_mode': 'verified',
+                'modified': '2019-10-17T22:43:41.734266Z',
+            })
+        return {
+            'key': key,
+            'aggregation_key': 'course:{}'.format(key),
+            'uuid': str(uuid.UUID(int=index)),
+            'title': 'Benchmark Course {}'.format(index),
+            'content_type': 'course',
+            'card_image_url': self.image_url(index),
+            'short_description': 'Short description of course {}'.format(index),
+            'full_description': 'Full description of course {}. '.format(index) * 20,
+            'subjects': ['Computer Science'],
+            'organizations': ['BenchX: Benchmark University'],
+            'languages': ['English'],
+            'enrollment_url': 'https://courses.edx.org/enterprise/bench/course/{}/enroll/'.format(key),
+            'course_runs': course_runs,
+        }
+
+    def image_url(self, index):
+        if not self.images:
+            return None
+        return "{}{}{}.png".format(self.base_url, IMAGE_PATH, index % self.images)
+
+    def respond_image(self, request, name):
+        try:
+            image_index = int(name.split('.')[0])
+        except ValueError:
+            self._count('not_found')
+            return self._respond(request, 404, {'detail': 'Not found.'})
+        content = make_png(1200, 675, ((image_index * 37) % 256, (image_index * 71) % 256, 128))
+        etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+        if request.headers.get('If-None-Match') == etag:
+            self._count('image_not_modified')
+            request.send_response(304)
+            request.send_header('ETag', etag)
+            request.end_headers()
+            return
+        self._count('image')
+        with self._lock:
+            self.bytes_sent += len(content)
+        request.send_response(200)
+        request.send_header('Content-Type', 'image/png')
+        request.send_header('Content-Length', str(len(content)))
+        request.send_header('ETag', etag)
+        request.end_headers()
+        request.wfile.write(content)
+
+    def _authorize(self, request):
+        token = request.headers.get('authorization', '')
+        with self._lock:
+            self._token_calls[token] += 1
+            return not self.token_max_calls or self._token_calls[token] <= self.token_max_calls
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def _respond(self, request, status, body):
+        content = json.dumps(body).encode('utf-8')
+        with self._lock:
+            self.bytes_sent += len(content)
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+
+
+def get_peak_rss_kb():
+    """Peak resident set size of this process in KB (Linux reports ru_maxrss in KB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_sync_benchmark(courses, runs=3, page_size=100, latency=0.0, token_max_calls=0, incremental=False,
+                       images=0):
+    """Run EdxorgCourses.set_edxorg_courses against StubEnterpriseApi and return measurements
+
+    With images the course image cache is enabled and writes into a temporary MEDIA_ROOT.
+    The caller is responsible for pointing the default database at a disposable (SQLite) database.
+    """
+    from openedx.features.edx_enterprise_api.api_client import ACCESS_TOKEN_CACHE_KEY
+    from openedx.features.edx_enterprise_api.views import EdxorgCourses
+
+    stub = StubEnterpriseApi(
+        courses=courses, runs=runs, page_size=page_size, latency=latency, token_max_calls=token_max_calls,
+        images=images).start()
+    InMemorySearchEngine.reset()
+    cache.delete(ACCESS_TOKEN_CACHE_KEY)
+    stub_settings = stub.settings()
+    media_root = None
+    if images:
+        media_root = tempfile.mkdtemp(prefix='edxorg_course_images')
+        stub_settings.update({'EDX_ENTERPRISE_COURSE_IMAGE_CACHE': True, 'MEDIA_ROOT': media_root})
+    try:
+        with override_settings(**stub_settings):
+            edx_courses = EdxorgCourses()
+            with CaptureQueriesContext(connection) as queries:
+                started = time.time()
+                summary = edx_courses.set_edxorg_courses(incremental=incremental)
+                wall_time = time.time() - started
+    finally:
+        stub.stop()
+        if media_root:
+            shutil.rmtree(media_root, ignore_errors=True)
+
+    return {
+        'courses': courses,
+        'runs': runs,
+        'wall_time': wall_time,
+        'http_calls': sum(stub.calls.values()),
+        'http_calls_by_endpoint': dict(stub.calls),
+        'bytes_downloaded': stub.bytes_sent,
+        'sql_queries': len(queries),
+        'index_requests': sum(InMemorySearchEngine.index_calls.values()),
+        'indexed_documents': len(InMemorySearchEngine.documents),
+        'peak_rss_kb': get_peak_rss_kb(),
+        'summary': dict(summary),
+        'stages': edx_courses.metrics.summary()['stages'],
+    }
@@ -1,11 +1,35 @@
+import datetime
+import hashlib
 import json
-import requests
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from six.moves import queue
 
 from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from openedx.features.edx_enterprise_api.api_client import get_http_session
+from openedx.features.edx_enterprise_api.sites import DEFAULT_SITE, DEFAULT_ORG_NAME
+
+
+def get_search_document_id(course_id, site=DEFAULT_SITE):
+    """Course discovery document id of course_id in the catalog of site; the default catalog uses the bare id"""
+    return "{}@{}".format(course_id, site) if site else course_id
+
 
+def delete_edxorg_courses_from_search(course_id=None, course_ids=None, site=DEFAULT_SITE):
+    """Delete edxorg course of site's catalog from ElasticSearch
 
-def delete_edxorg_courses_from_search(course_id=None):
-    """Delete edxorg course from ElasticSearch"""
+    Pass course_ids to remove many courses with a single delete-by-query. Documents are matched
+    by id, so the same course in another site's catalog is left alone. Raises when ElasticSearch
+    answers with an error or does not answer within EDX_ENTERPRISE_SEARCH_TIMEOUT (30) seconds,
+    so the index queue retries the delete.
+    """
+    if course_ids is not None:
+        course_ids = list(course_ids)
+        if not course_ids:
+            return
     headers = {'content-type': 'application/json'}
     ELASTIC_SEARCH_CONFIG = settings.ELASTIC_SEARCH_CONFIG[0]
     elasticsearch_url = "http://{}:{}".format(
@@ -15,6 +39,191 @@ def delete_edxorg_courses_from_search(course_id=None):
                 'port', 9200)))
     search_delete_1 = "{}/courseware_index/course_info/_query".format(
         elasticsearch_url)
-    payload = {"query": {"bool": {"must": [{"term": {"course": course_id}}]}}}
+    if course_ids is None:
+        course_ids = [course_id]
+    payload = {"query": {"ids": {"values": [get_search_document_id(course_id, site) for course_id in course_ids]}}}
+
+    response = get_http_session().delete(
+        search_delete_1, data=json.dumps(payload), headers=headers,
+        timeout=getattr(settings, 'EDX_ENTERPRISE_SEARCH_TIMEOUT', 30))
+    response.raise_for_status()
+
+
+# start date assumed for course runs that do not publish one
+DEFAULT_COURSE_RUN_START = datetime.datetime(2017, 1, 1)
+
+_INTERLEAVE_DONE = object()
+
+
+def interleave(iterables, max_workers=None):
+    """Yield items of several iterables as background threads produce them
+
+    Each iterable is consumed by its own worker thread (at most max_workers at once) and has at
+    most one item waiting for the consumer while it produces the next, so downloading the next
+    catalog page overlaps with saving the current one while memory stays flat however uneven the
+    iterables are. An exception raised by any iterable is re-raised to the consumer.
+    """
+    iterables = list(iterables)
+    if not iterables:
+        return
+    # every producer puts at most one item and its done entry, the queue never blocks
+    items = queue.Queue()
+    stopped = threading.Event()
+
+    def wait_taken(taken):
+        while not stopped.is_set():
+            if taken.wait(0.1):
+                taken.clear()
+                return True
+        return False
+
+    def produce(iterable):
+        # set by the consumer once it takes the item, bounding this producer alone
+        taken = threading.Event()
+        taken.set()
+        try:
+            for item in iterable:
+                if not wait_taken(taken):
+                    return
+                items.put((item, None, taken))
+        except Exception as error:
+            items.put((_INTERLEAVE_DONE, error, None))
+            return
+        items.put((_INTERLEAVE_DONE, None, None))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(iterables))
+    try:
+        for iterable in iterables:
+            executor.submit(produce, iterable)
+        remaining = len(iterables)
+        while remaining:
+            item, error, taken = items.get()
+            if error is not None:
+                raise error
+            if item is _INTERLEAVE_DONE:
+                remaining -= 1
+                continue
+            taken.set()
+            yield item
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False)
+
+
+def get_default_card_image_url():
+    """Card image of edx.org courses which have none"""
+    return "{}/static/edx_enterprise_api/images/course_default_image.jpeg".format(settings.LMS_ROOT_URL)
+
+
+def get_content_hash(content):
+    """Return sha1 hex digest of a text payload, used to detect unchanged courses between syncs"""
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def get_course_runs_modified(course):
+    """Return latest course_runs[].modified of an edx.org course as datetime, None if not known"""
+    modified_dates = [
+        parse_datetime(course_run['modified']) for course_run in course.get('course_runs') or []
+        if course_run.get('modified')]
+    modified_dates = [modified for modified in modified_dates if modified]
+    return max(modified_dates) if modified_dates else None
+
+
+def parse_course_run_datetime(value):
+    """Parse naive UTC datetime of edx.org course run fields like 'start' and 'enrollment_end', None if missing"""
+    if not value:
+        return None
+    for date_format in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ'):
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    return None
+
+
+def select_course_run(course_runs, now):
+    """Return the course run whose start is nearest to now and whose enrollment has not ended
+
+    Each run is parsed once in a single pass. A run without a parseable start is taken to start
+    on DEFAULT_COURSE_RUN_START. Ties go to the upcoming run rather than the one which already
+    started, then to list order. When enrollment has ended for every run the nearest run is
+    returned anyway. Returns None for an empty list.
+    """
+    nearest_run = nearest_enrollable_run = None
+    for index, course_run in enumerate(course_runs):
+        start = parse_course_run_datetime(course_run.get('start')) or DEFAULT_COURSE_RUN_START
+        time_difference = (now - start).total_seconds()
+        sort_key = (abs(time_difference), time_difference, index)
+
+        if nearest_run is None or sort_key < nearest_run[0]:
+            nearest_run = (sort_key, course_run)
+
+        enrollment_end = parse_course_run_datetime(course_run.get('enrollment_end'))
+        if enrollment_end is None or enrollment_end >= now:
+            if nearest_enrollable_run is None or sort_key < nearest_enrollable_run[0]:
+                nearest_enrollable_run = (sort_key, course_run)
+
+    selected_run = nearest_enrollable_run or nearest_run
+    return selected_run[1] if selected_run else None
+
+
+# upstream course and course run keys needed by the about page, reindexing and search
+COMPACT_COURSE_FIELDS = (
+    'aggregation_key', 'card_image_url', 'enrollment_url', 'key', 'subjects', 'title', 'uuid')
+COMPACT_COURSE_RUN_FIELDS = ('end', 'enrollment_end', 'enrollment_start', 'key', 'modified', 'start')
+
+
+def compact_course_payload(course, now):
+    """Return edx.org course stripped to COMPACT_COURSE_FIELDS and its still enrollable course runs
+
+    Runs whose enrollment has ended are dropped; when that is every run, the one
+    select_course_run picks is kept so the course can still be reindexed.
+    """
+    course_runs = course.get('course_runs') or []
+    open_course_runs = [
+        course_run for course_run in course_runs
+        if (parse_course_run_datetime(course_run.get('enrollment_end')) or now) >= now]
+    if not open_course_runs and course_runs:
+        open_course_runs = [select_course_run(course_runs, now)]
+
+    compact_course = dict((field, course[field]) for field in COMPACT_COURSE_FIELDS if field in course)
+    compact_course['course_runs'] = [
+        dict((field, course_run[field]) for field in COMPACT_COURSE_RUN_FIELDS if field in course_run)
+        for course_run in open_course_runs]
+    return compact_course
+
+
+def build_course_info(course_id, number, display_name, image_url, course_run, site=DEFAULT_SITE,
+                      org=DEFAULT_ORG_NAME):
+    """Build course discovery document of an edx.org course from its selected course run
+
+    course_run may be None or empty, then start and enrollment start fall back to 2017-01-01.
+    Documents of a site's own catalog carry its domain in 'site' and an id qualified by it.
+    """
+    course_run = course_run or {}
+    course_start = datetime.datetime.strptime(
+        course_run.get("start").split('T')[0]
+        if course_run.get("start") else "2017-01-01", '%Y-%m-%d').strftime('%b %d, %Y')
+
+    enrollment_start = datetime.datetime.strptime(
+        course_run.get("enrollment_start").split('T')[0]
+        if course_run.get("enrollment_start") else "2017-01-01", '%Y-%m-%d').strftime('%b %d, %Y')
 
-    requests.delete(search_delete_1, data=json.dumps(payload), headers=headers)
+    # make json format for reindexing courses in
+    # elasticsearch
+    course_info = {
+        'id': get_search_document_id(course_id, site),
+        'course': course_id,
+        'content': {
+            'number': number,
+            'display_name': display_name
+        },
+        'org': org,
+        'is_edx': True,
+        'image_url': image_url,
+        'start': course_start,
+        'enrollment_start': enrollment_start,
+    }
+    if site:
+        course_info['site'] = site
+    return course_info
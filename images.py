@@ -0,0 +1,189 @@
+"""Local cache of edx.org course card images.
+
+With EDX_ENTERPRISE_COURSE_IMAGE_CACHE enabled the sync downloads every course's card_image_url
+and stores it in EDX_ENTERPRISE_COURSE_IMAGE_STORAGE (the default file storage) under a
+content-addressed path:
+
+    <EDX_ENTERPRISE_COURSE_IMAGE_PATH>/<sha256[:2]>/<sha256>/original.<format>
+    <EDX_ENTERPRISE_COURSE_IMAGE_PATH>/<sha256[:2]>/<sha256>/<width>x<height>.jpg
+
+with one JPEG per size in EDX_ENTERPRISE_COURSE_IMAGE_SIZES. course_image then points at the
+first size, so course about pages and discovery cards no longer load the full size remote image.
+Identical images shared by several courses or urls are stored once.
+"""
+import hashlib
+import io
+import logging
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from PIL import Image, ImageOps
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import get_storage_class
+
+from openedx.features.edx_enterprise_api.api_client import get_http_session
+from openedx.features.edx_enterprise_api.instrumentation import SyncMetrics
+from openedx.features.edx_enterprise_api.models import EdxOrgCourseImage
+
+log = logging.getLogger(__name__)
+
+COURSE_IMAGE_PATH = 'edx_enterprise_api/course_images'
+
+# course discovery card size and its double density version
+COURSE_IMAGE_SIZES = ((378, 225), (756, 450))
+
+
+def is_course_image_cache_enabled():
+    return getattr(settings, 'EDX_ENTERPRISE_COURSE_IMAGE_CACHE', False)
+
+
+def get_course_image_sizes():
+    return [tuple(size) for size in getattr(settings, 'EDX_ENTERPRISE_COURSE_IMAGE_SIZES', COURSE_IMAGE_SIZES)]
+
+
+def get_url_hash(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def get_image_directory(content_hash):
+    return '{}/{}/{}'.format(
+        getattr(settings, 'EDX_ENTERPRISE_COURSE_IMAGE_PATH', COURSE_IMAGE_PATH), content_hash[:2], content_hash)
+
+
+def get_variant_path(content_hash, size):
+    return '{}/{}x{}.jpg'.format(get_image_directory(content_hash), size[0], size[1])
+
+
+def render_variants(image, sizes, quality=85):
+    """Return {size: JPEG bytes} of image cropped to the aspect ratio of each size and scaled down to it"""
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # JPEG has no transparency; flatten onto white rather than letting it turn black
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    variants = {}
+    for size in sizes:
+        output = io.BytesIO()
+        ImageOps.fit(image, size, Image.LANCZOS).save(output, 'JPEG', quality=quality, optimize=True, progressive=True)
+        variants[size] = output.getvalue()
+    return variants
+
+
+class CourseImageCache(object):
+    """ Download remote course images concurrently into local storage and map them to local variant urls.
+
+        Number of concurrent downloads is taken from EDX_ENTERPRISE_COURSE_IMAGE_WORKERS (default 8).
+        Images already cached are requested with If-None-Match/If-Modified-Since only when the caller
+        asks to revalidate them; a 304, or a body with the same sha256, keeps the stored variants.
+    """
+
+    def __init__(self, session=None, metrics=None, storage=None):
+        self.session = session or get_http_session()
+        self.metrics = metrics or SyncMetrics()
+        self.storage = storage or get_storage_class(getattr(settings, 'EDX_ENTERPRISE_COURSE_IMAGE_STORAGE', None))()
+        self.sizes = get_course_image_sizes()
+        self.timeout = getattr(settings, 'EDX_ENTERPRISE_API_TIMEOUT', 30)
+
+    def get_local_url(self, content_hash):
+        return self.storage.url(get_variant_path(content_hash, self.sizes[0]))
+
+    def get_cached_urls(self, source_urls):
+        """Return {source_url: local variant url} of the source_urls already cached, without downloading"""
+        images = EdxOrgCourseImage.objects.filter(url_hash__in=[get_url_hash(url) for url in set(source_urls)])
+        return dict((image.source_url, self.get_local_url(image.content_hash)) for image in images)
+
+    def cache_images(self, source_urls, revalidate_urls=()):
+        """Download source_urls not cached yet, and revalidate_urls, and return {source_url: local variant url}
+
+        A failed download is logged; the url maps to its earlier local variant if there is one.
+        """
+        source_urls = set(source_urls)
+        images = dict(
+            (image.source_url, image) for image in EdxOrgCourseImage.objects.filter(
+                url_hash__in=[get_url_hash(url) for url in source_urls]))
+        fetch_urls = [url for url in source_urls if url not in images or url in revalidate_urls]
+        self.metrics.increment('images_unchanged', len(source_urls) - len(fetch_urls))
+
+        if fetch_urls:
+            max_workers = getattr(settings, 'EDX_ENTERPRISE_COURSE_IMAGE_WORKERS', 8)
+            with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+                futures = dict(
+                    (executor.submit(self.fetch_image, url, images.get(url)), url) for url in fetch_urls)
+                for future in as_completed(futures):
+                    url = futures[future]
+                    try:
+                        images[url] = self.save_image(future.result())
+                    except Exception as e:
+                        log.exception("Course image download failed for %s: %s", url, e)
+                        self.metrics.increment('images_failed')
+
+        return dict((url, self.get_local_url(image.content_hash)) for url, image in images.items())
+
+    def save_image(self, image):
+        """Write image by url_hash; other sites' syncs may cache the same url concurrently"""
+        image, created = EdxOrgCourseImage.objects.update_or_create(
+            url_hash=image.url_hash,
+            defaults={
+                'source_url': image.source_url,
+                'content_hash': image.content_hash,
+                'etag': image.etag,
+                'last_modified': image.last_modified,
+            })
+        return image
+
+    def fetch_image(self, source_url, image=None):
+        """Download source_url and store its variants; returns image, or a new one, updated but unsaved"""
+        headers = {}
+        if image is not None:
+            if image.etag:
+                headers['If-None-Match'] = image.etag
+            if image.last_modified:
+                headers['If-Modified-Since'] = image.last_modified
+
+        with self.metrics.timer('image_download'):
+            response = self.session.get(source_url, headers=headers, timeout=self.timeout)
+            if response.status_code != 304:
+                response.raise_for_status()
+        self.metrics.increment('bytes_downloaded', len(response.content))
+
+        if image is None:
+            image = EdxOrgCourseImage(url_hash=get_url_hash(source_url), source_url=source_url)
+        if response.status_code == 304:
+            self.metrics.increment('images_unchanged')
+            return image
+
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        if content_hash == image.content_hash:
+            self.metrics.increment('images_unchanged')
+        else:
+            self.store_image(content_hash, response.content)
+            self.metrics.increment('images_downloaded')
+        image.content_hash = content_hash
+        image.etag = response.headers.get('ETag', '')
+        image.last_modified = response.headers.get('Last-Modified', '')
+        return image
+
+    def store_image(self, content_hash, content):
+        """Store original content and its variants under content_hash unless another url stored them already"""
+        if self.storage.exists(get_variant_path(content_hash, self.sizes[0])):
+            return
+        image = Image.open(io.BytesIO(content))
+        image_format = (image.format or 'jpeg').lower()
+        with self.metrics.timer('image_resize'):
+            variants = render_variants(image, self.sizes)
+        self.save_file('{}/original.{}'.format(get_image_directory(content_hash), image_format), content)
+        # the variant checked above is written last, so an interrupted store is redone
+        for size in reversed(self.sizes):
+            self.save_file(get_variant_path(content_hash, size), variants[size])
+
+    def save_file(self, path, content):
+        # storage.save renames rather than overwrites, which would move the file off its content address
+        if self.storage.exists(path):
+            self.storage.delete(path)
+        self.storage.save(path, ContentFile(content))
@@ -0,0 +1,448 @@
+"""Queued course discovery indexing of edx.org courses.
+
+Admin saves, EdxOrgCourse deletes and sync runs queue EdxOrgIndexOperation rows instead of
+calling ElasticSearch themselves. flush_index_queue applies them in bulk, keeping only the
+latest operation per course: one bulk index request per chunk and one delete-by-query per batch.
+
+The flush runs in celery when EDX_ENTERPRISE_INDEX_QUEUE_CELERY is set, else in a timer thread
+of the process that queued the operations. The process_edxorg_index_queue command drains the
+queue from cron or runs as a worker.
+
+rebuild_course_discovery_index instead writes every active course into a fresh staging index and
+swaps the courseware_index alias over to it, so stale courses drop out without any delete-by-query.
+"""
+import datetime
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk, scan
+from search.search_engine_base import SearchEngine
+
+from openedx.features.edx_enterprise_api.helpers import delete_edxorg_courses_from_search
+from openedx.features.edx_enterprise_api.instrumentation import SyncMetrics
+from openedx.features.edx_enterprise_api.models import EdxOrgCourse, EdxOrgIndexOperation
+from openedx.features.edx_enterprise_api.sites import DEFAULT_SITE
+
+log = logging.getLogger(__name__)
+
+INDEX_QUEUE_LOCK_CACHE_KEY = 'edx_enterprise_api.index_queue_lock'
+COURSE_DISCOVERY_INDEX = 'courseware_index'
+# bulk item status of a copy older than the document already in the target index
+VERSION_CONFLICT_STATUS = 409
+
+_flush_timer = None
+_flush_timer_lock = threading.Lock()
+
+
+def bulk_index_course_infos(course_infos, chunk_size=None, metrics=None):
+    """Index course_info documents in course discovery with one bulk request per chunk
+
+    Chunk size defaults to EDX_ENTERPRISE_INDEX_CHUNK_SIZE (500).
+    Returns set of document ids which could not be indexed.
+    """
+    metrics = metrics or SyncMetrics()
+    failed_course_ids = set()
+    searcher = SearchEngine.get_search_engine("courseware_index")
+
+    if not searcher or not course_infos:
+        return failed_course_ids
+
+    chunk_size = chunk_size or getattr(settings, 'EDX_ENTERPRISE_INDEX_CHUNK_SIZE', 500)
+    for start in range(0, len(course_infos), chunk_size):
+        chunk = course_infos[start:start + chunk_size]
+        chunk_failed_ids = set()
+        try:
+            with metrics.timer('es_index'):
+                searcher.index("course_info", chunk)
+        except Exception as error:
+            # elasticsearch BulkIndexError carries one error item per rejected document
+            bulk_errors = getattr(error, 'errors', None)
+            if isinstance(bulk_errors, list):
+                for bulk_error in bulk_errors:
+                    for action, result in bulk_error.items():
+                        chunk_failed_ids.add(result.get('_id'))
+                        log.error(
+                            "Course discovery indexing error encountered for %s: %s",
+                            result.get('_id'),
+                            result.get('error'))
+            else:
+                chunk_failed_ids = set(course_info.get("id", "") for course_info in chunk)
+                log.exception(
+                    "Course discovery indexing error encountered, course discovery index may be out of date %s",
+                    ", ".join(chunk_failed_ids))
+
+        failed_course_ids.update(chunk_failed_ids)
+        metrics.increment('es_index_failed_documents', len(chunk_failed_ids))
+        log.info(
+            "Successfully added %s of %s courses to the course discovery index",
+            len(chunk) - len(chunk_failed_ids),
+            len(chunk))
+    return failed_course_ids
+
+
+def apply_index_operations(operations, metrics=None):
+    """Apply the latest of operations per site and course to course discovery
+
+    Returns set of (site, course_id) whose operation failed.
+    """
+    metrics = metrics or SyncMetrics()
+    latest_operations = OrderedDict()
+    for operation in operations:
+        latest_operations.pop((operation.site, operation.course_id), None)
+        latest_operations[(operation.site, operation.course_id)] = operation
+
+    course_infos, delete_course_ids, row_course_ids = [], OrderedDict(), OrderedDict()
+    for (site, course_id), operation in latest_operations.items():
+        if operation.action == EdxOrgIndexOperation.ACTION_DELETE:
+            delete_course_ids.setdefault(site, []).append(course_id)
+        elif operation.course_info:
+            course_infos.append(operation.get_course_info())
+        else:
+            row_course_ids.setdefault(site, []).append(course_id)
+
+    now = datetime.datetime.now()
+    for site, course_ids in row_course_ids.items():
+        courses = EdxOrgCourse.objects.filter(site=site, course_id__in=course_ids).only(
+            'site', 'course_id', 'course_title', 'course_number', 'course_image', 'course_details_json', 'is_active')
+        for course in courses:
+            try:
+                course_info = course.get_course_info(now)
+            except (IndexError, TypeError, ValueError, SyntaxError) as error:
+                log.exception("Could not build course discovery document of %s: %s", course.course_id, error)
+                continue
+            if course_info:
+                course_infos.append(course_info)
+            else:
+                # deactivated since the index operation was queued
+                delete_course_ids.setdefault(site, []).append(course.course_id)
+
+    failed_keys = set()
+    for site, course_ids in delete_course_ids.items():
+        try:
+            with metrics.timer('es_delete'):
+                delete_edxorg_courses_from_search(course_ids=course_ids, site=site)
+        except Exception as error:
+            log.exception("Could not remove courses from course discovery: %s", error)
+            failed_keys.update((site, course_id) for course_id in course_ids)
+    document_keys = dict(
+        (course_info['id'], (course_info.get('site', DEFAULT_SITE), course_info['course']))
+        for course_info in course_infos)
+    failed_keys.update(
+        document_keys[document_id] for document_id in bulk_index_course_infos(course_infos, metrics=metrics)
+        if document_id in document_keys)
+    return failed_keys
+
+
+def flush_index_queue(batch_size=None, metrics=None):
+    """Apply queued index operations in batches of batch_size until the queue is empty
+
+    Only one flush runs at a time; a call made while another flush holds the lock returns at
+    once. The lock holder checks the queue again after releasing the lock and drains operations
+    queued by such calls after its last fetch. Failed operations are queued again up to
+    EDX_ENTERPRISE_INDEX_QUEUE_MAX_ATTEMPTS (5) times, unless a newer operation of the same site
+    and course is queued.
+
+    Returns number of operations processed.
+    """
+    batch_size = batch_size or getattr(settings, 'EDX_ENTERPRISE_INDEX_CHUNK_SIZE', 500)
+    max_attempts = getattr(settings, 'EDX_ENTERPRISE_INDEX_QUEUE_MAX_ATTEMPTS', 5)
+    lock_timeout = getattr(settings, 'EDX_ENTERPRISE_INDEX_QUEUE_LOCK_TIMEOUT', 10 * 60)
+    processed = 0
+    retried = False
+    flush_started = timezone.now()
+    # operations failed during this flush wait for the next one
+    pending_operations = EdxOrgIndexOperation.objects.exclude(attempts__gt=0, created__gte=flush_started)
+    while cache.add(INDEX_QUEUE_LOCK_CACHE_KEY, True, lock_timeout):
+        try:
+            processed_batches, batches_retried = _drain_index_queue(
+                pending_operations, batch_size, max_attempts, lock_timeout, metrics)
+            processed += processed_batches
+            retried = retried or batches_retried
+        finally:
+            cache.delete(INDEX_QUEUE_LOCK_CACHE_KEY)
+        # a call that found the lock taken after the last fetch above left its operations to this flush
+        if not pending_operations.exists():
+            break
+    if retried:
+        schedule_index_queue_flush()
+    return processed
+
+
+def _drain_index_queue(pending_operations, batch_size, max_attempts, lock_timeout, metrics):
+    """Apply pending_operations in batches until none is left; caller holds the index queue lock
+
+    Returns number of operations processed and whether any of them was queued again.
+    """
+    processed = 0
+    retried = False
+    while True:
+        operations = list(pending_operations.order_by('id')[:batch_size])
+        if not operations:
+            return processed, retried
+        failed_keys = apply_index_operations(operations, metrics)
+
+        with transaction.atomic():
+            EdxOrgIndexOperation.objects.filter(id__in=[operation.id for operation in operations]).delete()
+            superseded_keys = set(EdxOrgIndexOperation.objects.filter(
+                course_id__in=[course_id for site, course_id in failed_keys]).values_list('site', 'course_id'))
+            retry_operations = []
+            for operation in reversed(operations):
+                key = (operation.site, operation.course_id)
+                if key not in failed_keys or key in superseded_keys:
+                    continue
+                superseded_keys.add(key)
+                if operation.attempts + 1 >= max_attempts:
+                    log.error(
+                        "Giving up %s of %s after %s attempts", operation.action, operation.course_id, max_attempts)
+                    continue
+                retry_operations.append(EdxOrgIndexOperation(
+                    site=operation.site,
+                    course_id=operation.course_id,
+                    action=operation.action,
+                    course_info=operation.course_info,
+                    attempts=operation.attempts + 1))
+            EdxOrgIndexOperation.objects.bulk_create(list(reversed(retry_operations)))
+
+        processed += len(operations)
+        retried = retried or bool(retry_operations)
+        cache.set(INDEX_QUEUE_LOCK_CACHE_KEY, True, lock_timeout)
+
+
+def schedule_index_queue_flush():
+    """Have the index queue flushed shortly, coalescing operations queued in the meantime
+
+    Uses the celery task when EDX_ENTERPRISE_INDEX_QUEUE_CELERY is set, else one pending
+    timer thread per process. Delay is EDX_ENTERPRISE_INDEX_QUEUE_DELAY seconds (2).
+    """
+    global _flush_timer
+    delay = getattr(settings, 'EDX_ENTERPRISE_INDEX_QUEUE_DELAY', 2)
+    if getattr(settings, 'EDX_ENTERPRISE_INDEX_QUEUE_CELERY', False):
+        from openedx.features.edx_enterprise_api.tasks import flush_edxorg_index_queue
+        flush_edxorg_index_queue.apply_async(countdown=delay)
+        return
+
+    with _flush_timer_lock:
+        if _flush_timer is not None:
+            return
+        _flush_timer = threading.Timer(delay, _run_scheduled_flush)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+
+def _run_scheduled_flush():
+    global _flush_timer
+    with _flush_timer_lock:
+        _flush_timer = None
+    try:
+        flush_index_queue()
+    except Exception as e:
+        log.exception("Course discovery index queue flush failed: %s", e)
+    finally:
+        # the timer thread got its own database connection
+        connection.close()
+
+
+class IndexRebuildError(Exception):
+    """Raised when the staging index of a course discovery rebuild is not swapped in"""
+
+
+def get_edxorg_course_actions(index_name, now, metrics):
+    """Yield bulk index actions of every active EdxOrgCourse of every site into index_name, streaming the rows"""
+    courses = EdxOrgCourse.objects.filter(is_active=True).only(
+        'site', 'course_id', 'course_title', 'course_number', 'course_image', 'course_details_json', 'is_active')
+    for course in courses.iterator():
+        try:
+            course_info = course.get_course_info(now)
+        except (IndexError, TypeError, ValueError, SyntaxError) as error:
+            log.exception("Could not build course discovery document of %s: %s", course.course_id, error)
+            metrics.increment('es_rebuild_skipped_documents')
+            continue
+        yield {'_index': index_name, '_type': 'course_info', '_id': course_info['id'], '_source': course_info}
+
+
+def get_document_actions(es, source_index, target_index, query):
+    """Yield bulk index actions copying documents matching query from source_index into target_index
+
+    Copies keep the source document version as an external version, so copying a document again
+    only overwrites a target document of a lower version.
+    """
+    for hit in scan(es, index=source_index, query=query, version=True):
+        yield {
+            '_index': target_index,
+            '_type': hit['_type'],
+            '_id': hit['_id'],
+            '_version': hit['_version'],
+            '_version_type': 'external',
+            '_source': hit['_source'],
+        }
+
+
+def copy_documents(es, source_index, target_index, query, chunk_size):
+    """Copy documents matching query from source_index into target_index
+
+    Returns number of documents written and list of errors; documents the target already holds
+    in the same or a newer version are neither.
+    """
+    copied, errors = bulk(
+        es, get_document_actions(es, source_index, target_index, query), chunk_size=chunk_size, raise_on_error=False)
+    return copied, [
+        error for error in errors if list(error.values())[0].get('status') != VERSION_CONFLICT_STATUS]
+
+
+def swap_course_discovery_alias(es, staging_index, live_indexes, is_concrete_index, chunk_size):
+    """Point the courseware_index alias at staging_index, in place of live_indexes or the concrete index
+
+    Once the concrete index is deleted the alias is retried EDX_ENTERPRISE_INDEX_REBUILD_SWAP_ATTEMPTS
+    (5) times; a courseware_index created meanwhile by a platform write is copied into staging_index
+    and deleted before the next attempt. If every attempt fails staging_index is kept, so the alias
+    can be created by hand, and IndexRebuildError is raised.
+    """
+    alias = COURSE_DISCOVERY_INDEX
+    actions = [{'add': {'index': staging_index, 'alias': alias}}] + [
+        {'remove': {'index': live_index, 'alias': alias}} for live_index in live_indexes]
+    if not is_concrete_index:
+        es.indices.update_aliases(body={'actions': actions})
+        return
+
+    es.indices.delete(index=alias)
+    attempts = getattr(settings, 'EDX_ENTERPRISE_INDEX_REBUILD_SWAP_ATTEMPTS', 5)
+    for attempt in range(1, attempts + 1):
+        try:
+            if es.indices.exists(index=alias) and not es.indices.exists_alias(name=alias):
+                copy_documents(es, alias, staging_index, {'query': {'match_all': {}}}, chunk_size)
+                es.indices.delete(index=alias)
+            es.indices.update_aliases(body={'actions': actions})
+            return
+        except Exception as error:
+            log.exception("Could not point %s at %s (attempt %s of %s): %s", alias, staging_index, attempt,
+                          attempts, error)
+            if attempt < attempts:
+                time.sleep(attempt)
+    raise IndexRebuildError(
+        "{} was deleted but could not be made an alias of {}; the staging index is kept, add the alias "
+        "to it by hand".format(alias, staging_index))
+
+
+def rebuild_course_discovery_index(metrics=None, chunk_size=None, replace_concrete_index=False):
+    """Write active edx.org courses and every other course discovery document into a staging index,
+    validate it and atomically point the courseware_index alias at it
+
+    Index queue flushes must be held off by the caller (INDEX_QUEUE_LOCK_CACHE_KEY) for the
+    whole rebuild; operations queued before the course rows were read are covered by the new
+    index and dropped, later ones are left for the next flush.
+
+    Documents other than edx.org courses (platform courses and courseware content) are copied
+    from the live index with their versions. The platform keeps writing to the live index until
+    the swap, so once the alias points at the new index the previous one is copied again, which
+    only writes documents changed since the first copy, before it is deleted. Should that copy
+    fail the previous index is kept. Documents the platform deleted meanwhile stay until it
+    reindexes their course.
+    The swap is refused when edx.org documents would drop below
+    EDX_ENTERPRISE_INDEX_REBUILD_MIN_RATIO (0.5) of the live index.
+
+    The first rebuild needs replace_concrete_index when courseware_index is still a plain index:
+    it is copied again and deleted right before the alias is created, so search fails for that
+    moment (see swap_course_discovery_alias).
+
+    Returns name of the new index.
+    """
+    metrics = metrics or SyncMetrics()
+    chunk_size = chunk_size or getattr(settings, 'EDX_ENTERPRISE_INDEX_CHUNK_SIZE', 500)
+    es = Elasticsearch(settings.ELASTIC_SEARCH_CONFIG)
+    alias = COURSE_DISCOVERY_INDEX
+
+    live_indexes = list(es.indices.get_alias(name=alias)) if es.indices.exists_alias(name=alias) else []
+    is_concrete_index = not live_indexes and es.indices.exists(index=alias)
+    if is_concrete_index and not replace_concrete_index:
+        raise IndexRebuildError(
+            "{} is an index, not an alias; rebuild with replace_concrete_index to convert it".format(alias))
+    source_index = live_indexes[0] if live_indexes else (alias if is_concrete_index else None)
+
+    staging_index = "{}_{}".format(alias, timezone.now().strftime('%Y%m%d%H%M%S'))
+    index_body = {}
+    if source_index:
+        index_body['mappings'] = es.indices.get_mapping(index=source_index)[source_index]['mappings']
+        analysis = es.indices.get_settings(index=source_index)[source_index]['settings']['index'].get('analysis')
+        if analysis:
+            index_body['settings'] = {'analysis': analysis}
+    es.indices.create(index=staging_index, body=index_body)
+
+    other_query = {'query': {'bool': {'must_not': [{'term': {'is_edx': True}}]}}}
+    try:
+        # operations queued up to here are reflected in the rows read below
+        last_operation_id = EdxOrgIndexOperation.objects.aggregate(last_id=Max('id'))['last_id']
+        with metrics.timer('es_rebuild_index'):
+            edxorg_indexed, errors = bulk(
+                es, get_edxorg_course_actions(staging_index, datetime.datetime.now(), metrics),
+                chunk_size=chunk_size, raise_on_error=False)
+        if errors:
+            raise IndexRebuildError("{} edx.org courses could not be indexed".format(len(errors)))
+
+        other_copied = 0
+        if source_index:
+            with metrics.timer('es_rebuild_copy'):
+                other_copied, errors = copy_documents(es, source_index, staging_index, other_query, chunk_size)
+            if errors:
+                raise IndexRebuildError("{} course discovery documents could not be copied".format(len(errors)))
+
+        es.indices.refresh(index=staging_index)
+        staged_count = es.count(index=staging_index)['count']
+        if staged_count != edxorg_indexed + other_copied:
+            raise IndexRebuildError("{} holds {} documents, {} expected".format(
+                staging_index, staged_count, edxorg_indexed + other_copied))
+        if source_index:
+            live_edxorg_count = es.count(
+                index=source_index, body={'query': {'term': {'is_edx': True}}})['count']
+            min_ratio = getattr(settings, 'EDX_ENTERPRISE_INDEX_REBUILD_MIN_RATIO', 0.5)
+            if edxorg_indexed < live_edxorg_count * min_ratio:
+                raise IndexRebuildError("Only {} edx.org courses staged, live index has {}".format(
+                    edxorg_indexed, live_edxorg_count))
+
+        if is_concrete_index:
+            # the concrete index is gone after the swap, so catch up with its writes right before
+            with metrics.timer('es_rebuild_copy'):
+                copied, errors = copy_documents(es, source_index, staging_index, other_query, chunk_size)
+            if errors:
+                raise IndexRebuildError("{} course discovery documents could not be copied".format(len(errors)))
+            other_copied += copied
+    except Exception:
+        es.indices.delete(index=staging_index, ignore=404)
+        raise
+
+    # from here on staging_index is, or is about to be, the only course discovery index: never delete it
+    with metrics.timer('es_rebuild_swap'):
+        swap_course_discovery_alias(es, staging_index, live_indexes, is_concrete_index, chunk_size)
+
+    if last_operation_id is not None:
+        EdxOrgIndexOperation.objects.filter(id__lte=last_operation_id).delete()
+
+    keep_previous = getattr(settings, 'EDX_ENTERPRISE_INDEX_REBUILD_KEEP_PREVIOUS', False)
+    for live_index in live_indexes:
+        # platform writes which reached the previous index after the first copy
+        try:
+            with metrics.timer('es_rebuild_copy'):
+                copied, errors = copy_documents(es, live_index, staging_index, other_query, chunk_size)
+            if errors:
+                raise IndexRebuildError("{} course discovery documents could not be copied".format(len(errors)))
+        except Exception as error:
+            log.exception("Keeping %s, its latest documents could not be copied into %s: %s",
+                          live_index, staging_index, error)
+            continue
+        other_copied += copied
+        if not keep_previous:
+            es.indices.delete(index=live_index, ignore=404)
+    metrics.increment('es_rebuild_documents', edxorg_indexed + other_copied)
+    log.info(
+        "Course discovery index rebuilt into %s: %s edx.org courses, %s other documents",
+        staging_index, edxorg_indexed, other_copied)
+    return staging_index
@@ -0,0 +1,168 @@
+import logging
+import os
+import threading
+import time
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+log = logging.getLogger(__name__)
+
+# upper bounds in seconds of the stage latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+
+class SyncMetrics(object):
+    """ Thread safe call counts, latency histograms, error counts and counters of a catalog sync.
+
+        Stages used by the sync: token_fetch, catalog_page, marketing_url, db_upsert,
+        es_index, es_delete, stale_cleanup, image_download and image_resize and, for index
+        rebuilds, es_rebuild_index, es_rebuild_copy and es_rebuild_swap.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = OrderedDict()
+        self.counters = Counter()
+        self.started = time.time()
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {
+                'calls': 0,
+                'errors': 0,
+                'total_seconds': 0.0,
+                'max_seconds': 0.0,
+                'buckets': [0] * len(LATENCY_BUCKETS),
+            }
+        return self.stages[stage]
+
+    def observe(self, stage, seconds, error=False):
+        with self._lock:
+            stats = self._stage(stage)
+            stats['calls'] += 1
+            stats['errors'] += 1 if error else 0
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            for index, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    stats['buckets'][index] += 1
+                    break
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the block as one call of stage, counting it as an error if it raises"""
+        started = time.time()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(stage, time.time() - started, error)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def summary(self):
+        """Return plain dict of all stages and counters, histograms as cumulative bucket counts"""
+        with self._lock:
+            stages = OrderedDict()
+            for stage, stats in self.stages.items():
+                cumulative, buckets = 0, OrderedDict()
+                for upper_bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+                    cumulative += count
+                    buckets['+Inf' if upper_bound == float('inf') else str(upper_bound)] = cumulative
+                stages[stage] = OrderedDict((
+                    ('calls', stats['calls']),
+                    ('errors', stats['errors']),
+                    ('total_seconds', round(stats['total_seconds'], 6)),
+                    ('mean_seconds', round(stats['total_seconds'] / stats['calls'], 6) if stats['calls'] else 0),
+                    ('max_seconds', round(stats['max_seconds'], 6)),
+                    ('buckets', buckets),
+                ))
+            return {
+                'wall_seconds': round(time.time() - self.started, 6),
+                'stages': stages,
+                'counters': dict(self.counters),
+            }
+
+    def log_summary(self):
+        summary = self.summary()
+        log.info("edx.org courses sync finished in %.1fs", summary['wall_seconds'])
+        for stage, stats in summary['stages'].items():
+            log.info(
+                "edx.org courses sync stage %s: %s calls, %s errors, %.3fs total, %.3fs mean, %.3fs max",
+                stage, stats['calls'], stats['errors'], stats['total_seconds'], stats['mean_seconds'],
+                stats['max_seconds'])
+        for name, value in sorted(summary['counters'].items()):
+            log.info("edx.org courses sync counter %s: %s", name, value)
+
+    def export(self):
+        """Hand summary to every callable listed (as dotted path) in EDX_ENTERPRISE_SYNC_METRICS_SINKS"""
+        summary = self.summary()
+        for sink_path in getattr(settings, 'EDX_ENTERPRISE_SYNC_METRICS_SINKS', []):
+            try:
+                import_string(sink_path)(summary)
+            except Exception as e:
+                log.exception("edx.org courses sync metrics sink %s failed: %s", sink_path, e)
+
+
+def statsd_sink(summary):
+    """Send sync summary to statsd as timings and gauges, prefixed with EDX_ENTERPRISE_SYNC_METRICS_PREFIX"""
+    try:
+        import statsd
+    except ImportError:
+        log.warning("statsd is not installed, edx.org courses sync metrics are not sent")
+        return
+    prefix = getattr(settings, 'EDX_ENTERPRISE_SYNC_METRICS_PREFIX', 'edx_enterprise_api.sync')
+    client = statsd.StatsClient(
+        getattr(settings, 'STATSD_HOST', 'localhost'), getattr(settings, 'STATSD_PORT', 8125), prefix=prefix)
+    client.timing('wall', summary['wall_seconds'] * 1000)
+    for stage, stats in summary['stages'].items():
+        client.gauge('{}.calls'.format(stage), stats['calls'])
+        client.gauge('{}.errors'.format(stage), stats['errors'])
+        client.timing('{}.mean'.format(stage), stats['mean_seconds'] * 1000)
+        client.timing('{}.max'.format(stage), stats['max_seconds'] * 1000)
+    for name, value in summary['counters'].items():
+        client.gauge(name, value)
+
+
+def prometheus_text(summary):
+    """Render sync summary in Prometheus text exposition format"""
+    lines = [
+        '# TYPE edx_enterprise_sync_wall_seconds gauge',
+        'edx_enterprise_sync_wall_seconds {}'.format(summary['wall_seconds']),
+        '# TYPE edx_enterprise_sync_stage_seconds histogram',
+    ]
+    for stage, stats in summary['stages'].items():
+        for upper_bound, count in stats['buckets'].items():
+            lines.append('edx_enterprise_sync_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                stage, upper_bound, count))
+        lines.append('edx_enterprise_sync_stage_seconds_sum{{stage="{}"}} {}'.format(stage, stats['total_seconds']))
+        lines.append('edx_enterprise_sync_stage_seconds_count{{stage="{}"}} {}'.format(stage, stats['calls']))
+    lines.append('# TYPE edx_enterprise_sync_stage_errors gauge')
+    for stage, stats in summary['stages'].items():
+        lines.append('edx_enterprise_sync_stage_errors{{stage="{}"}} {}'.format(stage, stats['errors']))
+    lines.append('# TYPE edx_enterprise_sync_counter gauge')
+    for name, value in sorted(summary['counters'].items()):
+        lines.append('edx_enterprise_sync_counter{{name="{}"}} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def prometheus_textfile_sink(summary):
+    """Write sync summary to EDX_ENTERPRISE_SYNC_METRICS_TEXTFILE for node_exporter's textfile collector"""
+    path = getattr(settings, 'EDX_ENTERPRISE_SYNC_METRICS_TEXTFILE', None)
+    if not path:
+        log.warning("EDX_ENTERPRISE_SYNC_METRICS_TEXTFILE is not set, edx.org courses sync metrics are not written")
+        return
+    # write then rename so the collector never reads a partial file
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'w') as metrics_file:
+        metrics_file.write(prometheus_text(summary))
+    os.rename(temporary_path, path)
@@ -0,0 +1,49 @@
+import datetime
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from openedx.features.edx_enterprise_api.helpers import select_course_run
+
+
+def build_course_runs(run_count, now, rng):
+    """Build synthetic edx.org course runs spread two years around now, about half with closed enrollment"""
+    course_runs = []
+    for index in range(run_count):
+        start = now + datetime.timedelta(days=rng.randint(-730, 730))
+        enrollment_end = start + datetime.timedelta(days=rng.randint(-30, 60))
+        course_runs.append({
+            'key': 'course-v1:BenchX+B{}+{}'.format(index, start.year),
+            'start': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'enrollment_start': None,
+            'enrollment_end': enrollment_end.strftime('%Y-%m-%dT%H:%M:%SZ') if rng.random() < 0.8 else None,
+            'modified': now.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        })
+    return course_runs
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark select_course_run over a synthetic catalog with many runs per course"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--courses', type=int, default=2000)
+        parser.add_argument('--runs', type=int, nargs='+', default=[1, 5, 20, 100])
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        now = datetime.datetime.now()
+        rng = random.Random(options['seed'])
+
+        for run_count in options['runs']:
+            catalog = [build_course_runs(run_count, now, rng) for _ in range(options['courses'])]
+
+            def select_all():
+                for course_runs in catalog:
+                    select_course_run(course_runs, now)
+
+            best = min(timeit.repeat(select_all, number=1, repeat=options['repeat']))
+            self.stdout.write(
+                "{} courses x {} runs: {:.1f} ms per catalog, {:.2f} us per course".format(
+                    options['courses'], run_count, best * 1000, best * 1e6 / max(options['courses'], 1)))
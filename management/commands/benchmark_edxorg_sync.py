@@ -0,0 +1,60 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from openedx.features.edx_enterprise_api.benchmark import run_sync_benchmark
+
+
+class Command(BaseCommand):
+    help = ("Benchmark set_edxorg_courses against a local stand-in enterprise API, "
+            "a throwaway SQLite test database and an in-memory search engine")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--courses', type=int, nargs='+', default=[1000, 10000, 50000])
+        parser.add_argument('--runs', type=int, default=3, help='course runs per course')
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--latency-ms', type=float, default=0, help='latency added to every stub response')
+        parser.add_argument(
+            '--token-max-calls', type=int, default=0,
+            help='answer 401 expired after an access token was used this many times, 0 for never')
+        parser.add_argument(
+            '--images', type=int, default=0,
+            help='serve this many distinct card images and enable the course image cache, 0 for no images')
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='sync every catalog twice and also measure the second, incremental run')
+        parser.add_argument('--json', action='store_true', help='print one JSON object per run')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("Run with settings whose default database is SQLite, e.g. --settings=test")
+
+        old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            for courses in options['courses']:
+                runs = [False, True] if options['incremental'] else [False]
+                for incremental in runs:
+                    result = run_sync_benchmark(
+                        courses,
+                        runs=options['runs'],
+                        page_size=options['page_size'],
+                        latency=options['latency_ms'] / 1000.0,
+                        token_max_calls=options['token_max_calls'],
+                        incremental=incremental,
+                        images=options['images'])
+                    result['incremental'] = incremental
+                    self.write_result(result, options['json'])
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+    def write_result(self, result, as_json):
+        if as_json:
+            self.stdout.write(json.dumps(result, sort_keys=True))
+            return
+        self.stdout.write(
+            "{courses} courses x {runs} runs{mode}: {wall_time:.2f}s wall, {http_calls} HTTP calls, "
+            "{sql_queries} SQL queries, {index_requests} index requests, peak RSS {peak_rss_kb} KB".format(
+                mode=' (incremental)' if result['incremental'] else '', **result))
+        self.stdout.write("    HTTP calls by endpoint: {}".format(result['http_calls_by_endpoint']))
+        self.stdout.write("    sync summary: {}".format(result['summary']))
@@ -0,0 +1,75 @@
+import datetime
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from openedx.features.edx_enterprise_api.models import EdxOrgCourse, EdxOrgCourseArchive, is_compact_storage
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Move the full edx.org course document of existing EdxOrgCourse rows into the compressed "
+            "EdxOrgCourseArchive and strip their payload columns")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if not is_compact_storage():
+            # the sync would keep writing full payloads without refreshing the archive
+            raise CommandError("Set EDX_ENTERPRISE_COMPACT_STORAGE = True before compacting courses")
+        batch_size = options['batch_size']
+        now = datetime.datetime.now()
+        compacted = archived_descriptions = failed = 0
+        last_id = 0
+
+        while True:
+            courses = list(EdxOrgCourse.objects.filter(id__gt=last_id).order_by('id').only(
+                'id', 'site', 'course_id', 'course_details_json', 'short_description', 'full_description',
+                'content_hash', 'is_active')[:batch_size])
+            if not courses:
+                break
+            last_id = courses[-1].id
+            # an archive with another content hash predates a sync that ran without compact storage
+            site_course_ids = {}
+            for course in courses:
+                site_course_ids.setdefault(course.site, []).append(course.course_id)
+            archived_hashes = {}
+            for site, course_ids in site_course_ids.items():
+                # looked up per site, through the (site, course_id) unique index
+                archived_hashes.update(
+                    ((site, course_id), content_hash) for course_id, content_hash in
+                    EdxOrgCourseArchive.objects.filter(site=site, course_id__in=course_ids).values_list(
+                        'course_id', 'content_hash'))
+
+            courses_to_compact, archives, courses_to_clear = [], [], []
+            for course in courses:
+                if archived_hashes.get((course.site, course.course_id)) == course.content_hash:
+                    # compacted by an earlier run or sync; only a since deactivated course has work left
+                    if not course.is_active and course.full_description:
+                        courses_to_clear.append(course)
+                    continue
+                try:
+                    archives.append(course.compact(now))
+                except (ValueError, SyntaxError) as e:
+                    failed += 1
+                    log.error("Could not compact course_details_json of %s: %s", course.course_id, e)
+                    continue
+                courses_to_compact.append(course)
+
+            with transaction.atomic():
+                EdxOrgCourseArchive.objects.replace(archives, batch_size)
+                for course in courses_to_compact:
+                    EdxOrgCourse.objects.filter(pk=course.pk).update(
+                        course_details_json=course.course_details_json,
+                        short_description=course.short_description,
+                        full_description=course.full_description)
+                EdxOrgCourse.objects.filter(pk__in=[course.pk for course in courses_to_clear]).update(
+                    full_description='')
+            compacted += len(courses_to_compact)
+            archived_descriptions += len(courses_to_clear)
+
+        self.stdout.write("Compacted {} courses, archived {} inactive descriptions, {} failed".format(
+            compacted, archived_descriptions, failed))
@@ -0,0 +1,50 @@
+import ast
+import json
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from openedx.features.edx_enterprise_api.models import EdxOrgCourse
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Rewrite course_details_json stored as python repr into canonical JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        converted = failed = 0
+        batch = []
+        courses = EdxOrgCourse.objects.only('id', 'course_id', 'course_details_json').order_by('id')
+
+        for course in courses.iterator():
+            try:
+                json.loads(course.course_details_json)
+                continue
+            except ValueError:
+                pass
+            try:
+                course.course_details_json = json.dumps(ast.literal_eval(course.course_details_json))
+            except (ValueError, SyntaxError) as e:
+                failed += 1
+                log.error("Could not convert course_details_json of %s: %s", course.course_id, e)
+                continue
+            batch.append(course)
+            if len(batch) >= batch_size:
+                converted += self.save_batch(batch)
+                batch = []
+
+        converted += self.save_batch(batch)
+        self.stdout.write("Converted {} courses, {} failed".format(converted, failed))
+
+    def save_batch(self, batch):
+        with transaction.atomic():
+            for course in batch:
+                EdxOrgCourse.objects.filter(pk=course.pk).update(
+                    course_details_json=course.course_details_json)
+        return len(batch)
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from openedx.features.edx_enterprise_api.indexing import flush_index_queue
+
+
+class Command(BaseCommand):
+    help = "Apply queued course discovery index operations of edx.org courses"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument(
+            '--loop',
+            type=float,
+            metavar='SECONDS',
+            help='Keep running as a worker, flushing the queue every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = flush_index_queue(batch_size=options['batch_size'])
+            if processed or not options['loop']:
+                self.stdout.write("Processed {} index operations".format(processed))
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -1,17 +1,164 @@
+import cProfile
+import json
 import logging
+import sys
 
-from django.core.management.base import BaseCommand
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from openedx.features.edx_enterprise_api.views import EdxorgCourses
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from openedx.features.edx_enterprise_api.sites import DEFAULT_SITE, get_enterprise_sites
+from openedx.features.edx_enterprise_api.views import EdxorgCourses, SyncAlreadyRunning
 
 log = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Skip database write, marketing url lookup and reindex for courses unchanged since last sync')
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='Continue the last failed or interrupted sync from its checkpoint')
+        parser.add_argument(
+            '--rebuild-index',
+            action='store_true',
+            help='Write every active course into a fresh course discovery index and swap the '
+                 'courseware_index alias to it, instead of updating the live index course by course')
+        parser.add_argument(
+            '--replace-concrete-index',
+            action='store_true',
+            help='With --rebuild-index, delete courseware_index if it is a plain index so it can '
+                 'become an alias (first rebuild only)')
+        parser.add_argument(
+            '--export-snapshot',
+            metavar='DIR',
+            help='Crawl the catalog and write it as a compressed snapshot into DIR instead of syncing')
+        parser.add_argument(
+            '--import-snapshot',
+            metavar='DIR',
+            help='Sync from the snapshot in DIR instead of the edx.org API; honours --incremental')
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Fetch the catalog and report the courses a sync would create, update or deactivate, '
+                 'without writing to the database or search index')
+        parser.add_argument(
+            '--dry-run-output',
+            metavar='PATH',
+            help='Write the dry-run report as JSON lines to PATH instead of stdout')
+        parser.add_argument(
+            '--profile',
+            nargs='?',
+            const='set_edxorg_courses.prof',
+            default=None,
+            metavar='PATH',
+            help='Write a cProfile dump of the run to PATH (default set_edxorg_courses.prof). '
+                 'Only the main thread is profiled; fetch worker time shows up in the stage metrics')
+        parser.add_argument(
+            '--site',
+            action='append',
+            default=[],
+            metavar='DOMAIN',
+            help='Sync the catalog of the site with this domain instead of the default catalog; '
+                 'may be repeated to sync several sites in parallel')
+        parser.add_argument(
+            '--all-sites',
+            action='store_true',
+            help='Sync the default catalog and the catalog of every site configured with enterprise '
+                 'credentials, in parallel')
+
+    def get_sites(self, options):
+        sites = list(options['site'])
+        if options['all_sites']:
+            sites = [DEFAULT_SITE] + get_enterprise_sites()
+        sites = sites or [DEFAULT_SITE]
+        if len(sites) > 1 and (options['rebuild_index'] or options['export_snapshot']
+                               or options['import_snapshot'] or options['dry_run']):
+            raise CommandError(
+                "--rebuild-index, --export-snapshot, --import-snapshot and --dry-run take a single site")
+        return sites
+
     def handle(self, *args, **options):
+        sites = self.get_sites(options)
+        if len(sites) > 1:
+            self.sync_sites(sites, options)
+            return
+
+        profiler = cProfile.Profile() if options['profile'] else None
         try:
-            edx_courses = EdxorgCourses()
-            edx_courses.set_edxorg_courses()
+            edx_courses = EdxorgCourses(site=sites[0])
+            if profiler:
+                profiler.enable()
+            if options['dry_run']:
+                summary = self.dry_run(edx_courses, options['dry_run_output'])
+            elif options['export_snapshot']:
+                manifest = edx_courses.export_snapshot(options['export_snapshot'])
+                summary = {'exported': manifest['course_count']}
+            elif options['import_snapshot']:
+                summary = edx_courses.import_snapshot(
+                    options['import_snapshot'], incremental=options['incremental'])
+            else:
+                summary = edx_courses.set_edxorg_courses(
+                    incremental=options['incremental'],
+                    resume=options['resume'],
+                    rebuild_index=options['rebuild_index'],
+                    replace_concrete_index=options['replace_concrete_index'])
+            self.stdout.write(", ".join("{}: {}".format(name, count) for name, count in summary.items()))
+        except SyncAlreadyRunning as e:
+            self.stdout.write(str(e))
         except Exception as e:
             log.error(e)
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(options['profile'])
+                self.stdout.write("Profile written to {}".format(options['profile']))
+
+    def sync_sites(self, sites, options):
+        """Sync each site's catalog in its own thread, at most EDX_ENTERPRISE_SITE_WORKERS (4) at a time
+
+        A site failing or already syncing is reported and does not stop the others.
+        """
+        def sync_site(site):
+            try:
+                return EdxorgCourses(site=site).set_edxorg_courses(
+                    incremental=options['incremental'], resume=options['resume'])
+            except SyncAlreadyRunning as e:
+                return str(e)
+            except Exception as e:
+                log.exception(e)
+                return "failed: {}".format(e)
+            finally:
+                # worker threads open connections of their own, which Django would not close
+                connection.close()
+
+        max_workers = getattr(settings, 'EDX_ENTERPRISE_SITE_WORKERS', 4)
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            results = OrderedDict(zip(sites, executor.map(sync_site, sites)))
+        for site, summary in results.items():
+            if isinstance(summary, dict):
+                summary = ", ".join("{}: {}".format(name, count) for name, count in summary.items())
+            self.stdout.write("{}: {}".format(site or "default", summary))
+
+    def dry_run(self, edx_courses, output_path=None):
+        """Write one JSON line per change a sync would make and return counts per action"""
+        summary = Counter()
+        output = open(output_path, 'w') if output_path else sys.stdout
+        try:
+            for change in edx_courses.iter_catalog_changes():
+                summary[change['action']] += 1
+                if change['remove_from_index']:
+                    summary['remove_from_index'] += 1
+                output.write(json.dumps(change, sort_keys=True) + '\n')
+        finally:
+            if output_path:
+                output.close()
+        return summary
@@ -1,26 +1,174 @@
+import ast
+import datetime
+import hashlib
+import json
 import uuid
+import zlib
 
-from django.db import models
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Max
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 from model_utils.models import TimeStampedModel
 
-from openedx.features.edx_enterprise_api.helpers import delete_edxorg_courses_from_search
+from openedx.features.edx_enterprise_api.helpers import (
+    build_course_info,
+    compact_course_payload,
+    get_default_card_image_url,
+    select_course_run,
+)
+from openedx.features.edx_enterprise_api.sites import DEFAULT_SITE, get_org_name
+
+COURSE_ABOUT_RECORD_CACHE_KEY = 'edx_enterprise_api.course_about_record.{}'
+
+
+def get_course_cache_key(key_format, course_id, *parts):
+    """Build cache key for course_id; course ids come from urls so they are hashed to stay memcached safe"""
+    course_hash = hashlib.md5(course_id.encode('utf-8')).hexdigest()
+    return key_format.format('.'.join((course_hash,) + tuple(str(part) for part in parts)))
+
+
+def get_site_course_cache_key(key_format, site, course_id, *parts):
+    """get_course_cache_key of course_id in site's catalog; keys of the default catalog are unchanged"""
+    return get_course_cache_key(key_format, "{}@{}".format(course_id, site) if site else course_id, *parts)
+
+
+# columns derived from the upstream course payload; equal content_hash means they are equal too
+PAYLOAD_FIELDS = ('course_details_json', 'short_description', 'full_description')
+
+
+def get_changed_fields(course, course_details):
+    """Return names of fields in course_details whose values differ from course
+
+    Payload derived text columns are compared through content_hash when course_details carries one,
+    so they may stay deferred on course. Shared by the sync upsert and the dry-run diff.
+    """
+    compare_by_hash = 'content_hash' in course_details
+    content_changed = compare_by_hash and course.content_hash != course_details['content_hash']
+    changed_fields = []
+    for field, value in course_details.items():
+        if compare_by_hash and field in PAYLOAD_FIELDS:
+            if content_changed:
+                changed_fields.append(field)
+        elif getattr(course, field) != value:
+            changed_fields.append(field)
+    return changed_fields
+
+
+def is_compact_storage():
+    """EDX_ENTERPRISE_COMPACT_STORAGE stores compact payloads and archives raw edx.org documents"""
+    return getattr(settings, 'EDX_ENTERPRISE_COMPACT_STORAGE', False)
 
 
 class EdxOrgCoursesQuerySet(models.QuerySet):
 
     def delete(self, *args, **kwargs):
-        """set is_active false for delete courses and remove from ElasticSearch"""
-        for obj in self:
-            delete_edxorg_courses_from_search(course_id=obj.course_id)
-            obj.is_active = False
-            obj.save()
+        """set is_active false for delete courses and queue their removal from ElasticSearch
+
+        Runs one UPDATE per site for the whole queryset; the index worker removes them with one
+        delete-by-query per site.
+        """
+        site_course_ids = OrderedDict()
+        for site, course_id in self.values_list('site', 'course_id'):
+            site_course_ids.setdefault(site, []).append(course_id)
+        if not site_course_ids:
+            return
+        with transaction.atomic():
+            for site, course_ids in site_course_ids.items():
+                self.model.objects.filter(site=site, course_id__in=course_ids).update(
+                    is_active=False, modified=timezone.now())
+                EdxOrgIndexOperation.objects.enqueue(EdxOrgIndexOperation.ACTION_DELETE, course_ids, site=site)
+        for site, course_ids in site_course_ids.items():
+            self.model.clear_about_records(course_ids, site)
+
+    def bulk_upsert(self, course_details_list, batch_size=None, site=DEFAULT_SITE):
+        """Create or update courses of site's catalog from dicts of field values keyed on course_id
+
+        Each batch loads existing rows with one course_id__in query and writes them with
+        bulk_create/bulk_update in a single transaction. Batch size defaults to
+        EDX_ENTERPRISE_SYNC_BATCH_SIZE (500).
+
+        Rows whose values did not change are left untouched, so their modified
+        timestamp and cached about page stay valid.
+
+        Returns (created_course_ids, updated_course_ids)
+        """
+        batch_size = batch_size or getattr(settings, 'EDX_ENTERPRISE_SYNC_BATCH_SIZE', 500)
+        # later duplicates of a course_id win, same as calling update_or_create in order
+        details_by_course_id = OrderedDict(
+            (course_details['course_id'], course_details) for course_details in course_details_list)
+        course_ids = list(details_by_course_id)
+        created_course_ids, updated_course_ids = [], []
+
+        for start in range(0, len(course_ids), batch_size):
+            batch_course_ids = course_ids[start:start + batch_size]
+            existing_courses = {
+                course.course_id: course for course in self.filter(
+                    site=site, course_id__in=batch_course_ids).defer('course_details_json', 'short_description')}
+            now = timezone.now()
+            courses_to_create, courses_to_update, archives = [], [], []
+            # rows grouped by changed columns so bulk_update never reads a deferred payload column
+            courses_by_update_fields = OrderedDict()
+
+            for course_id in batch_course_ids:
+                course_details = details_by_course_id[course_id]
+                course = existing_courses.get(course_id)
+                if course is None:
+                    courses_to_create.append(self.model(site=site, **course_details))
+                    continue
+                changed_fields = get_changed_fields(course, course_details)
+                if not changed_fields:
+                    continue
+                for field in changed_fields:
+                    setattr(course, field, course_details[field])
+                # bulk writes skip save(), so bump TimeStampedModel.modified by hand
+                course.modified = now
+                courses_to_update.append(course)
+                update_fields = tuple(sorted(set(changed_fields + ['modified']) - set(['course_id'])))
+                courses_by_update_fields.setdefault(update_fields, []).append(course)
+
+            if is_compact_storage():
+                # rows whose payload did not change keep their compact columns and archive
+                archives = [course.compact() for course in courses_to_create] + [
+                    course.compact() for update_fields, courses in courses_by_update_fields.items()
+                    if 'course_details_json' in update_fields for course in courses]
+            with transaction.atomic():
+                if courses_to_create:
+                    self.bulk_create(courses_to_create, batch_size=batch_size)
+                for update_fields, courses in courses_by_update_fields.items():
+                    self._bulk_update(courses, list(update_fields), batch_size)
+                if archives:
+                    EdxOrgCourseArchive.objects.replace(archives, batch_size)
+
+            self.model.cache_about_records(courses_to_create + courses_to_update)
+            created_course_ids.extend(course.course_id for course in courses_to_create)
+            updated_course_ids.extend(course.course_id for course in courses_to_update)
+
+        return created_course_ids, updated_course_ids
+
+    def _bulk_update(self, courses, fields, batch_size):
+        """Use QuerySet.bulk_update where django provides it (2.2+), else one UPDATE per row"""
+        if hasattr(models.QuerySet, 'bulk_update'):
+            self.bulk_update(courses, fields, batch_size=batch_size)
+            return
+        for course in courses:
+            self.filter(pk=course.pk).update(
+                **{field: getattr(course, field) for field in fields})
 
 
 class EdxOrgCourse(TimeStampedModel):
-    """This table contain details of EdX Enterprise Courses"""
-    course_id = models.CharField(max_length=128, unique=True)
+    """This table contain details of EdX Enterprise Courses
+
+    Each site with enterprise credentials of its own has its catalog under its domain in site,
+    the default catalog is stored under DEFAULT_SITE; see sites.py.
+    """
+    site = models.CharField(max_length=255, blank=True, default=DEFAULT_SITE)
+    course_id = models.CharField(max_length=128)
     course_title = models.CharField(max_length=255)
     course_number = models.CharField(max_length=255)
     course_image = models.CharField(max_length=1024)
@@ -31,6 +179,8 @@ class EdxOrgCourse(TimeStampedModel):
     course_enrollment_url = models.CharField(
         max_length=512, null=True, blank=True)
     course_details_json = models.TextField()
+    content_hash = models.CharField(max_length=40, blank=True, default='')
+    course_runs_modified = models.DateTimeField(null=True, blank=True)
     is_edx = models.BooleanField(default=True)
     is_active = models.BooleanField(default=True)
 
@@ -38,15 +188,324 @@ class EdxOrgCourse(TimeStampedModel):
 
     class Meta:
         app_label = "edx_enterprise_api"
+        unique_together = (('site', 'course_id'),)
+        indexes = [
+            # active course ids of a site: sync stale cleanup, course listing
+            models.Index(fields=['site', 'is_active', 'course_id'], name='edxorg_course_active_id_idx'),
+            # active courses of a site by last change
+            models.Index(fields=['site', 'is_active', 'modified'], name='edxorg_course_active_mod_idx'),
+            # admin changelist filters and title search/sort
+            models.Index(fields=['is_edx', 'is_active', 'course_title'], name='edxorg_course_admin_idx'),
+            # admin course id and course key lookups across sites
+            models.Index(fields=['course_id'], name='edxorg_course_id_idx'),
+        ]
 
     def delete(self, *args, **kwargs):
-        """set is_active false for delete course and remove from ElasticSearch"""
-        delete_edxorg_courses_from_search(course_id=self.course_id)
+        """set is_active false for delete course and queue its removal from ElasticSearch"""
         self.is_active = False
-        self.save()
+        with transaction.atomic():
+            self.save()
+            EdxOrgIndexOperation.objects.enqueue(EdxOrgIndexOperation.ACTION_DELETE, [self.course_id], site=self.site)
+        self.cache_about_records([self])
+
+    def get_course_details(self):
+        """Return course_details_json as dict, reading legacy python repr payloads too
+
+        Under compact storage this is the compact payload; see get_raw_course_details.
+        """
+        try:
+            return json.loads(self.course_details_json)
+        except ValueError:
+            return ast.literal_eval(self.course_details_json)
+
+    def get_raw_course_details(self):
+        """Return the full edx.org course document, read from EdxOrgCourseArchive when archived"""
+        archive = EdxOrgCourseArchive.objects.filter(site=self.site, course_id=self.course_id).first()
+        if archive is not None and archive.content_hash == self.content_hash:
+            return archive.get_course_details()
+        return self.get_course_details()
+
+    def compact(self, now=None):
+        """Strip payload columns to what the about page and reindexing use
+
+        Shrinks course_details_json with compact_course_payload and clears short_description;
+        full_description is only kept while the course is active. Returns unsaved
+        EdxOrgCourseArchive holding the full document, which must be saved along with the row.
+        """
+        raw_course_details = self.get_course_details()
+        now = now or datetime.datetime.now()
+        self.course_details_json = json.dumps(compact_course_payload(raw_course_details, now), sort_keys=True)
+        self.short_description = ''
+        if not self.is_active:
+            self.full_description = ''
+        return EdxOrgCourseArchive.from_course_details(
+            self.course_id, self.content_hash, raw_course_details, site=self.site)
+
+    def get_about_record(self):
+        """Return compact render context for edxorg_course_about.html built from row columns only
+
+        'version' changes whenever the row is saved and is used to key the rendered page cache.
+        """
+        return {
+            'course_id': self.course_id,
+            'title': self.course_title,
+            'course_number': self.course_number,
+            'org': get_org_name(self.site),
+            'card_image_url': self.course_image or get_default_card_image_url(),
+            'full_description': self.full_description or self.get_archived_full_description(),
+            'course_marketing_url': self.course_marketing_url,
+            'enroll_url': self.course_enrollment_url,
+            'is_course_available': self.is_active,
+            'version': self.modified.strftime('%Y%m%d%H%M%S%f') if self.modified else '',
+        }
+
+    def get_course_info(self, now):
+        """Build course discovery document from the row, None if course is not active
+
+        Title, number and image come from the columns so admin edits are indexed; start dates
+        come from the course run select_course_run picks out of the stored payload.
+        """
+        if not self.is_active:
+            return None
+        return build_course_info(
+            self.course_id,
+            self.course_number,
+            self.course_title,
+            self.course_image or None,
+            select_course_run(self.get_course_details().get('course_runs') or [], now),
+            site=self.site,
+            org=get_org_name(self.site))
+
+    def get_archived_full_description(self):
+        """Full description of a compacted inactive course, read from its archive"""
+        if self.is_active:
+            return ''
+        return self.get_raw_course_details().get('full_description') or ''
+
+    @classmethod
+    def get_last_modified(cls, site=DEFAULT_SITE):
+        """Return latest modified time of any row of site's catalog, None for an empty catalog
+
+        Taken per is_active value so both lookups are served by the (site, is_active, modified) index;
+        deactivating a course bumps modified too.
+        """
+        last_modified_dates = [
+            cls.objects.filter(site=site, is_active=is_active).aggregate(
+                last_modified=Max('modified'))['last_modified']
+            for is_active in (True, False)]
+        last_modified_dates = [modified for modified in last_modified_dates if modified]
+        return max(last_modified_dates) if last_modified_dates else None
+
+    @classmethod
+    def cache_about_records(cls, courses):
+        """Store about page render records of courses in cache"""
+        if courses:
+            cache.set_many(
+                {get_site_course_cache_key(COURSE_ABOUT_RECORD_CACHE_KEY, course.site, course.course_id):
+                 course.get_about_record() for course in courses},
+                getattr(settings, 'EDX_ENTERPRISE_COURSE_ABOUT_CACHE_TIMEOUT', 86400))
+
+    @classmethod
+    def clear_about_records(cls, course_ids, site=DEFAULT_SITE):
+        """Drop cached about page render records of course_ids in site's catalog"""
+        cache.delete_many(
+            [get_site_course_cache_key(COURSE_ABOUT_RECORD_CACHE_KEY, site, course_id) for course_id in course_ids])
+
+    @classmethod
+    def get_cached_about_record(cls, course_id, site=DEFAULT_SITE):
+        """Return about page render record of course_id in site's catalog from cache, loading it on miss"""
+        about_record = cache.get(get_site_course_cache_key(COURSE_ABOUT_RECORD_CACHE_KEY, site, course_id))
+        if about_record is None:
+            course = cls.objects.defer('course_details_json', 'short_description').get(
+                site=site, course_id=course_id)
+            cls.cache_about_records([course])
+            about_record = course.get_about_record()
+        return about_record
 
     def __unicode__(self):
         return self.course_id
 
     def __repr__(self):
         return self.__unicode__()
+
+
+class EdxOrgCourseArchiveQuerySet(models.QuerySet):
+
+    def replace(self, archives, batch_size=None):
+        """Store archives, replacing any earlier archive of the same site and course_id"""
+        site_course_ids = {}
+        for archive in archives:
+            site_course_ids.setdefault(archive.site, []).append(archive.course_id)
+        for site, course_ids in site_course_ids.items():
+            self.filter(site=site, course_id__in=course_ids).delete()
+        self.bulk_create(archives, batch_size=batch_size)
+
+
+class EdxOrgCourseArchive(models.Model):
+    """zlib compressed full edx.org course document of a compacted EdxOrgCourse
+
+    Kept out of EdxOrgCourse so listing, sync and about page queries never read it.
+    """
+    site = models.CharField(max_length=255, blank=True, default=DEFAULT_SITE)
+    course_id = models.CharField(max_length=128)
+    content_hash = models.CharField(max_length=40, blank=True, default='')
+    compressed_course_details = models.BinaryField()
+
+    objects = EdxOrgCourseArchiveQuerySet.as_manager()
+
+    class Meta:
+        app_label = "edx_enterprise_api"
+        unique_together = (('site', 'course_id'),)
+
+    @classmethod
+    def from_course_details(cls, course_id, content_hash, course_details, site=DEFAULT_SITE):
+        return cls(
+            site=site,
+            course_id=course_id,
+            content_hash=content_hash,
+            compressed_course_details=zlib.compress(json.dumps(course_details, sort_keys=True).encode('utf-8')))
+
+    def get_course_details(self):
+        return json.loads(zlib.decompress(bytes(self.compressed_course_details)).decode('utf-8'))
+
+    def __unicode__(self):
+        return self.course_id
+
+
+class EdxOrgCourseImage(models.Model):
+    """Remote edx.org card image cached in local storage, see images.CourseImageCache
+
+    Keyed by a hash of the remote url; content_hash is the sha256 of the downloaded bytes and
+    addresses the stored original and its pre-sized variants. etag and last_modified are the
+    validators sent back when the image is checked again.
+    """
+    url_hash = models.CharField(max_length=40, unique=True)
+    source_url = models.TextField()
+    content_hash = models.CharField(max_length=64)
+    etag = models.CharField(max_length=255, blank=True, default='')
+    last_modified = models.CharField(max_length=64, blank=True, default='')
+    checked = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = "edx_enterprise_api"
+
+    def __unicode__(self):
+        return self.source_url
+
+
+class EdxOrgIndexOperationQuerySet(models.QuerySet):
+
+    def enqueue(self, action, course_ids, course_infos=None, schedule=True, site=DEFAULT_SITE):
+        """Queue index or delete operations of course_ids in site's catalog for the index worker
+
+        course_infos maps course_id to a course discovery document built by the caller; other
+        courses are indexed from their row when the queue is flushed. With schedule the flush
+        is requested once the current transaction commits.
+        """
+        course_infos = course_infos or {}
+        operations = [
+            self.model(
+                site=site,
+                course_id=course_id,
+                action=action,
+                course_info=json.dumps(course_infos[course_id]) if course_id in course_infos else '')
+            for course_id in course_ids]
+        if not operations:
+            return
+        self.bulk_create(operations)
+        if schedule:
+            from openedx.features.edx_enterprise_api.indexing import schedule_index_queue_flush
+            transaction.on_commit(schedule_index_queue_flush)
+
+
+class EdxOrgIndexOperation(models.Model):
+    """Pending course discovery index change of one course, applied in bulk by indexing.flush_index_queue
+
+    Operations are applied in id order and only the latest one per site and course is kept.
+    """
+    ACTION_INDEX = 'index'
+    ACTION_DELETE = 'delete'
+    ACTION_CHOICES = (
+        (ACTION_INDEX, 'Index'),
+        (ACTION_DELETE, 'Delete'),
+    )
+
+    site = models.CharField(max_length=255, blank=True, default=DEFAULT_SITE)
+    course_id = models.CharField(max_length=128)
+    action = models.CharField(max_length=8, choices=ACTION_CHOICES)
+    # prebuilt course discovery document as JSON, empty to build it from the row
+    course_info = models.TextField(blank=True, default='')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = EdxOrgIndexOperationQuerySet.as_manager()
+
+    class Meta:
+        app_label = "edx_enterprise_api"
+
+    def get_course_info(self):
+        return json.loads(self.course_info) if self.course_info else None
+
+    def __unicode__(self):
+        return "{} {}{}".format(self.action, self.course_id, " ({})".format(self.site) if self.site else "")
+
+
+class EdxOrgSyncRun(TimeStampedModel):
+    """Progress of one set_edxorg_courses run of a site's catalog, checkpointed so a failed run can be resumed"""
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETED = 'completed'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_COMPLETED, 'Completed'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    site = models.CharField(max_length=255, blank=True, default=DEFAULT_SITE)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_RUNNING, db_index=True)
+    incremental = models.BooleanField(default=False)
+    # {catalog_uuid: next page url to fetch, or null once the catalog is done}
+    catalog_checkpoints = models.TextField(default='{}')
+    # course ids seen so far, needed to find stale courses after a resume
+    processed_course_ids = models.TextField(default='[]')
+    error = models.TextField(blank=True, default='')
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        app_label = "edx_enterprise_api"
+        get_latest_by = 'created'
+
+    @classmethod
+    def start(cls, incremental=False, resume=False, site=DEFAULT_SITE):
+        """Return run of site to work on: its last unfinished run when resume is set, else a new one
+
+        Must only be called while holding the site's sync lock, so any run still marked running has crashed.
+        """
+        sync_run = cls.objects.filter(site=site).order_by('-created').first() if resume else None
+        if sync_run is None or sync_run.status == cls.STATUS_COMPLETED:
+            return cls.objects.create(site=site, incremental=incremental)
+        sync_run.status = cls.STATUS_RUNNING
+        sync_run.incremental = incremental
+        sync_run.error = ''
+        sync_run.save()
+        return sync_run
+
+    def get_catalog_checkpoints(self):
+        return json.loads(self.catalog_checkpoints)
+
+    def get_processed_course_ids(self):
+        return json.loads(self.processed_course_ids)
+
+    def checkpoint(self, catalog_checkpoints, processed_course_ids):
+        self.catalog_checkpoints = json.dumps(catalog_checkpoints)
+        self.processed_course_ids = json.dumps(sorted(processed_course_ids))
+        self.save(update_fields=['catalog_checkpoints', 'processed_course_ids', 'modified'])
+
+    def finish(self, status, error=''):
+        self.status = status
+        self.error = error
+        self.finished = timezone.now()
+        self.save(update_fields=['status', 'error', 'finished', 'modified'])
+
+    def __unicode__(self):
+        return "{} {}".format(self.created, self.status)
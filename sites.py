@@ -0,0 +1,85 @@
+"""Per-site edx.org enterprise catalogs.
+
+A site whose SiteConfiguration values carry EDX_ENTERPRISE_API_CLIENT_ID has a catalog of its own:
+its EdxOrgCourse rows, search documents, sync runs, locks, access token and cached about pages are
+keyed by the site domain. Credentials, API urls, EDX_ENTERPRISE_CATALOG_UUIDS and
+EDX_ENTERPRISE_ORG_NAME are read from the site configuration, falling back to django settings.
+
+Every other site is served the default catalog, synced with the django settings and stored
+under DEFAULT_SITE.
+
+Course discovery documents of every catalog share one index and are told apart by org only, so
+a site catalog needs an EDX_ENTERPRISE_ORG_NAME of its own, matched by its course_org_filter.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from openedx.core.djangoapps.site_configuration import helpers as configuration_helpers
+from openedx.core.djangoapps.site_configuration.models import SiteConfiguration
+
+DEFAULT_SITE = ''
+
+# course discovery org of edx.org courses, also used by the site's course_org_filter
+DEFAULT_ORG_NAME = 'edX Courses'
+
+# seconds a site configuration is reused before it is read again
+SITE_CONFIGURATION_CACHE_TIMEOUT = 60
+
+_site_configurations = {}
+_site_configurations_lock = threading.Lock()
+
+
+def get_site_configuration(site):
+    """Enabled SiteConfiguration of site domain, None if there is none; kept in process for a minute"""
+    with _site_configurations_lock:
+        site_configuration, expires_at = _site_configurations.get(site, (None, 0))
+    if time.time() < expires_at:
+        return site_configuration
+
+    site_configuration = SiteConfiguration.objects.select_related('site').filter(
+        site__domain=site, enabled=True).first()
+    with _site_configurations_lock:
+        _site_configurations[site] = (site_configuration, time.time() + SITE_CONFIGURATION_CACHE_TIMEOUT)
+    return site_configuration
+
+
+def get_site_setting(site, name, default=None):
+    """Value of setting name for site: its site configuration value, else the django setting"""
+    if site:
+        site_configuration = get_site_configuration(site)
+        value = site_configuration.get_value(name) if site_configuration else None
+        if value is not None:
+            return value
+    return getattr(settings, name, default)
+
+
+def get_org_name(site):
+    return get_site_setting(site, 'EDX_ENTERPRISE_ORG_NAME', DEFAULT_ORG_NAME)
+
+
+def check_site_org_name(site):
+    """Raise ImproperlyConfigured when site's catalog would be indexed under the default catalog's org"""
+    if site and get_org_name(site) == get_org_name(DEFAULT_SITE):
+        raise ImproperlyConfigured(
+            "EDX_ENTERPRISE_ORG_NAME of {} must differ from the default catalog's {!r}, "
+            "its courses would show up on every site".format(site, get_org_name(DEFAULT_SITE)))
+
+
+def get_enterprise_sites():
+    """Domains of enabled sites configured with enterprise credentials of their own"""
+    return sorted(
+        site_configuration.site.domain
+        for site_configuration in SiteConfiguration.objects.select_related('site').filter(enabled=True)
+        if site_configuration.get_value('EDX_ENTERPRISE_API_CLIENT_ID'))
+
+
+def get_request_site():
+    """Catalog site of the current request: its domain when it has enterprise credentials, else DEFAULT_SITE"""
+    site_configuration = configuration_helpers.get_current_site_configuration()
+    if site_configuration and site_configuration.enabled and site_configuration.get_value(
+            'EDX_ENTERPRISE_API_CLIENT_ID'):
+        return site_configuration.site.domain
+    return DEFAULT_SITE
@@ -0,0 +1,104 @@
+"""Portable snapshots of the normalized edx.org catalog.
+
+A snapshot is a directory holding courses.ndjson.gz, one JSON record per course:
+
+    {"catalog_uuid": ..., "course": <edx.org course>, "course_marketing_url": ...}
+
+and manifest.json with the format version, creation time, course count and sha256 of the
+data file. The manifest is written last, so a directory without one is an unfinished export.
+"""
+import gzip
+import hashlib
+import json
+import os
+
+from django.utils import timezone
+
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_DATA_FILE = 'courses.ndjson.gz'
+SNAPSHOT_MANIFEST_FILE = 'manifest.json'
+
+
+class SnapshotError(Exception):
+    """Raised for a missing, unfinished or corrupt catalog snapshot"""
+
+
+class SnapshotWriter(object):
+    """Write catalog snapshot records into directory path; use as a context manager
+
+    The manifest is only written when the block exits without an exception.
+    """
+
+    def __init__(self, path, catalog_uuids=()):
+        self.path = path
+        self.catalog_uuids = list(catalog_uuids)
+        self.course_count = 0
+        self.manifest = None
+        self._data_file = None
+
+    def __enter__(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        manifest_path = os.path.join(self.path, SNAPSHOT_MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            # the directory is about to hold new data; never leave the old manifest describing it
+            os.remove(manifest_path)
+        self._data_file = gzip.open(os.path.join(self.path, SNAPSHOT_DATA_FILE), 'wb')
+        return self
+
+    def write(self, catalog_uuid, course, course_marketing_url):
+        record = {'catalog_uuid': catalog_uuid, 'course': course, 'course_marketing_url': course_marketing_url}
+        self._data_file.write((json.dumps(record, sort_keys=True) + '\n').encode('utf-8'))
+        self.course_count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._data_file.close()
+        if exc_type is not None:
+            return
+        self.manifest = {
+            'format_version': SNAPSHOT_FORMAT_VERSION,
+            'created': timezone.now().isoformat(),
+            'course_count': self.course_count,
+            'catalog_uuids': self.catalog_uuids,
+            'data_file': SNAPSHOT_DATA_FILE,
+            'sha256': get_file_sha256(os.path.join(self.path, SNAPSHOT_DATA_FILE)),
+        }
+        temporary_path = os.path.join(self.path, '{}.{}.tmp'.format(SNAPSHOT_MANIFEST_FILE, os.getpid()))
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2, sort_keys=True)
+        os.rename(temporary_path, os.path.join(self.path, SNAPSHOT_MANIFEST_FILE))
+
+
+def get_file_sha256(file_path, block_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as data_file:
+        for block in iter(lambda: data_file.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def read_snapshot_manifest(path):
+    """Return manifest of the snapshot in directory path after checking its data file checksum"""
+    manifest_path = os.path.join(path, SNAPSHOT_MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        raise SnapshotError("{} has no {}, the export is missing or unfinished".format(path, SNAPSHOT_MANIFEST_FILE))
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+        raise SnapshotError("Unsupported snapshot format version {}".format(manifest.get('format_version')))
+    if get_file_sha256(os.path.join(path, manifest['data_file'])) != manifest['sha256']:
+        raise SnapshotError("Checksum of {} does not match its manifest".format(manifest['data_file']))
+    return manifest
+
+
+def iter_snapshot_batches(path, manifest, batch_size):
+    """Yield lists of at most batch_size snapshot records, streaming the data file"""
+    batch = []
+    with gzip.open(os.path.join(path, manifest['data_file']), 'rb') as data_file:
+        for line in data_file:
+            batch.append(json.loads(line.decode('utf-8')))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
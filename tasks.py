@@ -0,0 +1,9 @@
+from celery.task import task
+
+from openedx.features.edx_enterprise_api.indexing import flush_index_queue
+
+
+@task(name='edx_enterprise_api.flush_edxorg_index_queue', ignore_result=True)
+def flush_edxorg_index_queue():
+    """Apply queued course discovery index operations, see indexing.flush_index_queue"""
+    flush_index_queue()
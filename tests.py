@@ -1,3 +1,665 @@
-from django.test import TestCase
+import datetime
+import email.utils
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+import mock
+import requests
+
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from openedx.features.edx_enterprise_api.api_client import (
+    AdaptiveConcurrencyLimiter,
+    EnterpriseApiClient,
+    get_retry_after,
+)
+from openedx.features.edx_enterprise_api.helpers import interleave, select_course_run
+from openedx.features.edx_enterprise_api.images import CourseImageCache, get_url_hash
+from openedx.features.edx_enterprise_api import benchmark, indexing
+from openedx.features.edx_enterprise_api.indexing import INDEX_QUEUE_LOCK_CACHE_KEY, flush_index_queue
+from openedx.features.edx_enterprise_api.models import (
+    EdxOrgCourse,
+    EdxOrgCourseImage,
+    EdxOrgIndexOperation,
+    EdxOrgSyncRun,
+)
+from openedx.features.edx_enterprise_api.snapshot import (
+    SNAPSHOT_DATA_FILE,
+    SNAPSHOT_MANIFEST_FILE,
+    SnapshotError,
+    SnapshotWriter,
+)
+from openedx.features.edx_enterprise_api.typeahead import CourseTypeaheadIndex
+from openedx.features.edx_enterprise_api.views import EdxorgCourseList, EdxorgCourses
+
+NOW = datetime.datetime(2018, 6, 1)
+
+
+def course_run(key, start=None, enrollment_end=None):
+    run = {'key': key}
+    if start is not None:
+        run['start'] = start
+    if enrollment_end is not None:
+        run['enrollment_end'] = enrollment_end
+    return run
+
+
+class SelectCourseRunTest(TestCase):
+
+    def test_nearest_run(self):
+        course_runs = [
+            course_run('old', start='2017-06-01T00:00:00Z'),
+            course_run('current', start='2018-05-20T00:00:00Z'),
+            course_run('next', start='2018-09-01T00:00:00Z'),
+        ]
+        self.assertEqual(select_course_run(course_runs, NOW)['key'], 'current')
+
+    def test_skips_runs_whose_enrollment_ended(self):
+        course_runs = [
+            course_run('closed', start='2018-05-20T00:00:00Z', enrollment_end='2018-05-25T00:00:00Z'),
+            course_run('open', start='2018-09-01T00:00:00Z', enrollment_end='2018-09-15T00:00:00.000000Z'),
+        ]
+        self.assertEqual(select_course_run(course_runs, NOW)['key'], 'open')
+
+    def test_falls_back_to_nearest_run_when_every_enrollment_ended(self):
+        course_runs = [
+            course_run('older', start='2017-06-01T00:00:00Z', enrollment_end='2017-06-15T00:00:00Z'),
+            course_run('recent', start='2018-05-20T00:00:00Z', enrollment_end='2018-05-25T00:00:00Z'),
+        ]
+        self.assertEqual(select_course_run(course_runs, NOW)['key'], 'recent')
+
+    def test_missing_or_unparseable_start_is_taken_as_default_start(self):
+        now = datetime.datetime(2017, 1, 10)
+        for start in (None, '', 'not a date'):
+            course_runs = [course_run('dated', start='2017-03-01T00:00:00Z'), course_run('undated', start=start)]
+            self.assertEqual(select_course_run(course_runs, now)['key'], 'undated')
+
+    def test_tie_goes_to_upcoming_run(self):
+        course_runs = [
+            course_run('started', start='2018-05-25T00:00:00Z'),
+            course_run('upcoming', start='2018-06-08T00:00:00Z'),
+        ]
+        self.assertEqual(select_course_run(course_runs, NOW)['key'], 'upcoming')
+
+    def test_tie_of_same_start_goes_to_first_run(self):
+        course_runs = [
+            course_run('first', start='2018-05-25T00:00:00Z'),
+            course_run('second', start='2018-05-25T00:00:00Z'),
+        ]
+        self.assertEqual(select_course_run(course_runs, NOW)['key'], 'first')
+
+    def test_empty_list(self):
+        self.assertIsNone(select_course_run([], NOW))
+
+
+class InterleaveTest(TestCase):
+
+    def test_yields_every_item(self):
+        items = list(interleave([iter(range(3)), iter(range(10, 12)), iter([])]))
+        self.assertEqual(sorted(items), [0, 1, 2, 10, 11])
+
+    def test_reraises_error_of_iterable(self):
+        def failing():
+            yield 1
+            raise ValueError("page failed")
+
+        with self.assertRaises(ValueError):
+            list(interleave([failing()]))
+
+    def test_fast_iterable_runs_one_item_ahead(self):
+        produced = []
+        released = threading.Event()
+
+        def fast():
+            for number in range(20):
+                produced.append(number)
+                yield number
+
+        def slow():
+            released.wait(5)
+            return
+            yield
+
+        items = interleave([fast(), slow(), slow()])
+        self.assertEqual(next(items), 0)
+        time.sleep(0.3)
+        # one item waiting for the consumer and one in the producer's hands
+        self.assertEqual(produced, [0, 1, 2])
+        released.set()
+        self.assertEqual(list(items), list(range(1, 20)))
+
+
+def response_with_retry_after(retry_after):
+    response = requests.Response()
+    if retry_after is not None:
+        response.headers['Retry-After'] = retry_after
+    return response
+
+
+class GetRetryAfterTest(TestCase):
+
+    def test_delta_seconds(self):
+        self.assertEqual(get_retry_after(response_with_retry_after('7')), 7)
+        self.assertEqual(get_retry_after(response_with_retry_after('-3')), 0)
+
+    def test_http_date(self):
+        retry_after = email.utils.formatdate(time.time() + 30, usegmt=True)
+        self.assertAlmostEqual(get_retry_after(response_with_retry_after(retry_after)), 30, delta=2)
+        retry_after = email.utils.formatdate(time.time() - 30, usegmt=True)
+        self.assertEqual(get_retry_after(response_with_retry_after(retry_after)), 0)
+
+    def test_missing_or_invalid(self):
+        self.assertIsNone(get_retry_after(response_with_retry_after(None)))
+        self.assertIsNone(get_retry_after(response_with_retry_after('soon')))
+
+
+class AdaptiveConcurrencyLimiterTest(TestCase):
+
+    def test_throttled_call_halves_limit_down_to_minimum(self):
+        limiter = AdaptiveConcurrencyLimiter(8, minimum=3)
+        for expected_limit in (4, 3, 3):
+            limiter.acquire()
+            limiter.release(throttled=True)
+            self.assertEqual(limiter.limit, expected_limit)
+
+    def test_limit_grows_by_one_after_limit_successes_up_to_maximum(self):
+        limiter = AdaptiveConcurrencyLimiter(4)
+        limiter.acquire()
+        limiter.release(throttled=True)
+        self.assertEqual(limiter.limit, 2)
+        for _ in range(2):
+            limiter.acquire()
+            limiter.release()
+        self.assertEqual(limiter.limit, 3)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release()
+        self.assertEqual(limiter.limit, 4)
+
+    def test_acquire_waits_for_release_at_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEqual(limiter.active, 1)
+
+
+class StubSession(object):
+    """requests.Session stand-in answering with the given responses or raising the given errors in turn"""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+
+    def request(self, method, url, **kwargs):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def response_with_status(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return response
+
+
+@override_settings(EDX_ENTERPRISE_API_MAX_CONCURRENCY=2, EDX_ENTERPRISE_API_MAX_RETRIES=1,
+                   EDX_ENTERPRISE_API_BACKOFF_MAX=0)
+class EnterpriseApiClientSendTest(TestCase):
+
+    def test_errors_not_retried_release_their_slot(self):
+        errors = [requests.exceptions.MissingSchema('no schema'), requests.exceptions.InvalidURL('bad url'),
+                  requests.exceptions.ChunkedEncodingError('cut'), requests.exceptions.TooManyRedirects('loop')]
+        client = EnterpriseApiClient(session=StubSession(errors))
+        for error in errors:
+            with self.assertRaises(type(error)):
+                client.send('GET', 'http://api/next')
+            self.assertEqual(client.limiter.active, 0)
+
+    def test_retried_calls_release_each_slot(self):
+        client = EnterpriseApiClient(session=StubSession([
+            requests.ConnectionError('reset'), response_with_status(200),
+            response_with_status(503), response_with_status(503),
+            requests.Timeout('slow'), requests.Timeout('slow'),
+        ]))
+        self.assertEqual(client.send('GET', 'http://api/').status_code, 200)
+        self.assertEqual(client.send('GET', 'http://api/').status_code, 503)
+        self.assertEqual(client.limiter.limit, 1)
+        with self.assertRaises(requests.Timeout):
+            client.send('GET', 'http://api/')
+        self.assertEqual(client.limiter.active, 0)
+
+
+def create_course(number, title=None, **kwargs):
+    return EdxOrgCourse.objects.create(
+        course_id='course:TestX+{}'.format(number),
+        course_title=title or 'Test Course {}'.format(number),
+        course_number='TestX+{}'.format(number),
+        course_image='',
+        course_details_json='{}',
+        **kwargs)
+
+
+def course_details(number, title=None, content_hash='hash'):
+    return {
+        'course_id': 'course:TestX+{}'.format(number),
+        'course_title': title or 'Test Course {}'.format(number),
+        'course_number': 'TestX+{}'.format(number),
+        'course_image': '',
+        'course_details_json': '{}',
+        'content_hash': content_hash,
+    }
+
+
+class BulkUpsertTest(TestCase):
+
+    def setUp(self):
+        EdxOrgCourse.objects.bulk_upsert([course_details(number) for number in range(3)], batch_size=2)
+        self.modified = dict(EdxOrgCourse.objects.values_list('course_id', 'modified'))
+
+    def test_counts_created_updated_and_unchanged_courses(self):
+        created, updated = EdxOrgCourse.objects.bulk_upsert([
+            course_details(0),
+            course_details(1, title='Renamed'),
+            course_details(2, content_hash='new hash'),
+            course_details(3),
+        ], batch_size=2)
+
+        self.assertEqual(created, ['course:TestX+3'])
+        self.assertEqual(updated, ['course:TestX+1', 'course:TestX+2'])
+        self.assertEqual(EdxOrgCourse.objects.count(), 4)
+        self.assertEqual(EdxOrgCourse.objects.get(course_id='course:TestX+1').course_title, 'Renamed')
+
+    def test_unchanged_course_keeps_modified(self):
+        EdxOrgCourse.objects.bulk_upsert([course_details(0), course_details(1, title='Renamed')])
+
+        modified = dict(EdxOrgCourse.objects.values_list('course_id', 'modified'))
+        self.assertEqual(modified['course:TestX+0'], self.modified['course:TestX+0'])
+        self.assertGreater(modified['course:TestX+1'], self.modified['course:TestX+1'])
+
+    def test_later_duplicate_wins(self):
+        created, updated = EdxOrgCourse.objects.bulk_upsert(
+            [course_details(1, title='First'), course_details(1, title='Second')])
+
+        self.assertEqual((created, updated), ([], ['course:TestX+1']))
+        self.assertEqual(EdxOrgCourse.objects.get(course_id='course:TestX+1').course_title, 'Second')
+
+    def test_courses_of_other_site_are_separate(self):
+        created, updated = EdxOrgCourse.objects.bulk_upsert([course_details(0)], site='tenant.example.com')
+
+        self.assertEqual((created, updated), (['course:TestX+0'], []))
+        self.assertEqual(EdxOrgCourse.objects.filter(course_id='course:TestX+0').count(), 2)
+
+
+class EdxorgCourseListTest(TestCase):
+
+    def setUp(self):
+        self.courses = [create_course(number) for number in ('C1', 'C2', 'C3')]
+        self.view = EdxorgCourseList.as_view()
+        self.factory = RequestFactory()
+
+    def get(self, params=None, **headers):
+        return self.view(self.factory.get('/api/edx_enterprise/v1/courses/', params or {}, **headers))
+
+    def test_cursor_round_trip(self):
+        modified = timezone.now()
+        cursor = EdxorgCourseList.encode_cursor(modified, 42)
+        self.assertEqual(EdxorgCourseList.decode_cursor(cursor), (modified, 42))
+
+    def test_invalid_cursor(self):
+        for cursor in ('not base64!', 'bm90IGpzb24=', EdxorgCourseList.encode_cursor(timezone.now(), 1)[:-4]):
+            with self.assertRaises(ValueError):
+                EdxorgCourseList.decode_cursor(cursor)
+        self.assertEqual(self.get({'cursor': 'bm90IGpzb24='}).status_code, 400)
+
+    def test_pages_follow_cursor(self):
+        first_page = json.loads(self.get({'page_size': 2, 'fields': 'course_id'}).content)
+        self.assertEqual(
+            [course['course_id'] for course in first_page['results']], ['course:TestX+C1', 'course:TestX+C2'])
+        self.assertIsNotNone(first_page['next'])
+
+        second_page = json.loads(
+            self.get({'page_size': 2, 'fields': 'course_id', 'cursor': first_page['cursor']}).content)
+        self.assertEqual([course['course_id'] for course in second_page['results']], ['course:TestX+C3'])
+        self.assertIsNone(second_page['next'])
+
+        # polling with the last cursor returns only courses changed since
+        self.courses[0].save()
+        changed = json.loads(self.get({'fields': 'course_id', 'cursor': second_page['cursor']}).content)
+        self.assertEqual([course['course_id'] for course in changed['results']], ['course:TestX+C1'])
+
+    def test_inactive_courses_are_listed_on_request(self):
+        EdxOrgCourse.objects.filter(pk=self.courses[1].pk).update(is_active=False)
+        listed = json.loads(self.get({'fields': 'course_id,is_active'}).content)['results']
+        self.assertEqual(len(listed), 2)
+        listed = json.loads(self.get({'fields': 'course_id,is_active', 'include_inactive': 'true'}).content)['results']
+        self.assertIn({'course_id': 'course:TestX+C2', 'is_active': False}, listed)
+
+    def test_conditional_requests(self):
+        response = self.get({'fields': 'course_id'})
+        self.assertEqual(response.status_code, 200)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        self.assertEqual(self.get({'fields': 'course_id'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.get({'fields': 'course_id'}, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        # the ETag covers the query too
+        self.assertEqual(self.get({'fields': 'course_title'}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        EdxOrgCourse.objects.filter(pk=self.courses[0].pk).update(
+            modified=timezone.now() + datetime.timedelta(seconds=5))
+        self.assertEqual(self.get({'fields': 'course_id'}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_unknown_field(self):
+        self.assertEqual(self.get({'fields': 'course_details_json'}).status_code, 400)
+
+
+TYPEAHEAD_COURSES = [
+    ('course:X+PY1', u'Python for Data Science', 'X+PY1', [u'Computer Science'], '/py1'),
+    ('course:X+PY2', u'Introduction to Python', 'X+PY2', [u'Computer Science'], '/py2'),
+    ('course:X+FR1', u'Fran\xe7ais avanc\xe9', 'X+FR1', [u'Language'], '/fr1'),
+    ('course:X+MA1', u'Machine Learning', 'X+MA1', [u'Data Analysis'], '/ma1'),
+    ('course:X+ST1', u'Statistics and Data', 'X+ST1', [u'Mathematics'], '/st1'),
+]
+
+
+class CourseTypeaheadIndexTest(TestCase):
+
+    def setUp(self):
+        self.index = CourseTypeaheadIndex(TYPEAHEAD_COURSES)
+
+    def search(self, query, limit=10):
+        return [course['course_id'] for course in self.index.search(query, limit)]
+
+    def test_prefix_matches_titles_starting_with_query_first(self):
+        self.assertEqual(self.search('pyth'), ['course:X+PY1', 'course:X+PY2'])
+        self.assertEqual(self.search('p'), ['course:X+PY1', 'course:X+PY2'])
+
+    def test_matches_number_and_subjects(self):
+        self.assertEqual(self.search('py2'), ['course:X+PY2'])
+        self.assertEqual(self.search('data'), ['course:X+MA1', 'course:X+PY1', 'course:X+ST1'])
+
+    def test_every_word_must_match(self):
+        self.assertEqual(self.search('data sci'), ['course:X+PY1'])
+        self.assertEqual(self.search('python learning'), [])
+
+    def test_accents_and_case_are_ignored(self):
+        self.assertEqual(self.search('francais'), ['course:X+FR1'])
+        self.assertEqual(self.search(u'FRAN\xc7'), ['course:X+FR1'])
+        self.assertEqual(self.search(u'avanc\xe9'), ['course:X+FR1'])
+
+    def test_typo_is_corrected_when_nothing_matches(self):
+        self.assertEqual(self.search('pythn'), ['course:X+PY1', 'course:X+PY2'])
+        self.assertEqual(self.search('machne lerning'), ['course:X+MA1'])
+        self.assertEqual(self.search('qzxw'), [])
+
+    def test_limit(self):
+        self.assertEqual(self.search('data', limit=2), ['course:X+MA1', 'course:X+PY1'])
+        self.assertEqual(self.search('data', limit=0), [])
+
+    def test_empty_query(self):
+        self.assertEqual(self.search(''), [])
+        self.assertEqual(self.search('  -  '), [])
+
+    def test_results_carry_course_summary(self):
+        self.assertEqual(self.index.search('intro'), [
+            {'course_id': 'course:X+PY2', 'title': u'Introduction to Python', 'number': 'X+PY2', 'url': '/py2'}])
+
+
+class CourseImageCacheTest(TestCase):
+
+    def test_save_image_of_url_cached_meanwhile_by_another_sync(self):
+        source_url = 'http://cdn/card.png'
+        # another site's sync stored the url after this one looked it up
+        EdxOrgCourseImage.objects.create(
+            url_hash=get_url_hash(source_url), source_url=source_url, content_hash='a' * 64, etag='"other"')
+
+        image = CourseImageCache(session=StubSession([])).save_image(EdxOrgCourseImage(
+            url_hash=get_url_hash(source_url), source_url=source_url, content_hash='b' * 64, etag='"own"'))
+
+        self.assertIsNotNone(image.pk)
+        image = EdxOrgCourseImage.objects.get(url_hash=get_url_hash(source_url))
+        self.assertEqual((image.content_hash, image.etag), ('b' * 64, '"own"'))
+
+
+TENANT_SITE = 'tenant.example.com'
+
+
+def enqueue(action, course_id, site='', course_info=None):
+    EdxOrgIndexOperation.objects.enqueue(
+        action, [course_id], course_infos={course_id: course_info} if course_info else None,
+        schedule=False, site=site)
+
+
+def document(course_id, site=''):
+    course_info = {'id': '{}@{}'.format(course_id, site) if site else course_id, 'course': course_id}
+    if site:
+        course_info['site'] = site
+    return course_info
+
+
+class FlushIndexQueueTest(TestCase):
+
+    def setUp(self):
+        cache.delete(INDEX_QUEUE_LOCK_CACHE_KEY)
+        patchers = [
+            mock.patch.object(indexing, 'delete_edxorg_courses_from_search'),
+            mock.patch.object(indexing, 'bulk_index_course_infos', return_value=set()),
+            mock.patch.object(indexing, 'schedule_index_queue_flush'),
+        ]
+        self.delete, self.bulk_index, self.schedule = [patcher.start() for patcher in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+    def test_keeps_latest_operation_per_site_and_course(self):
+        enqueue(EdxOrgIndexOperation.ACTION_INDEX, 'course:A', course_info=document('course:A'))
+        enqueue(EdxOrgIndexOperation.ACTION_DELETE, 'course:A')
+        enqueue(EdxOrgIndexOperation.ACTION_INDEX, 'course:A', site=TENANT_SITE,
+                course_info=document('course:A', TENANT_SITE))
+
+        self.assertEqual(flush_index_queue(), 3)
+
+        self.delete.assert_called_once_with(course_ids=['course:A'], site='')
+        self.assertEqual(self.bulk_index.call_args[0][0], [document('course:A', TENANT_SITE)])
+        self.assertFalse(EdxOrgIndexOperation.objects.exists())
+        self.assertFalse(self.schedule.called)
+
+    def test_failed_operation_is_queued_again(self):
+        enqueue(EdxOrgIndexOperation.ACTION_DELETE, 'course:A')
+        enqueue(EdxOrgIndexOperation.ACTION_DELETE, 'course:A', site=TENANT_SITE)
+        self.delete.side_effect = lambda course_ids, site: self.fail_on_site(site, '')
+
+        flush_index_queue()
+
+        operation = EdxOrgIndexOperation.objects.get()
+        self.assertEqual((operation.site, operation.course_id, operation.attempts), ('', 'course:A', 1))
+        self.assertEqual(self.delete.call_count, 2)
+        self.assertTrue(self.schedule.called)
+
+    def test_failed_operation_superseded_by_newer_one_is_dropped(self):
+        def delete(course_ids, site):
+            if self.delete.call_count == 1:
+                # an admin edit queued while the delete was running
+                enqueue(EdxOrgIndexOperation.ACTION_INDEX, 'course:A', course_info=document('course:A'))
+                raise requests.ConnectionError("refused")
+
+        enqueue(EdxOrgIndexOperation.ACTION_DELETE, 'course:A')
+        self.delete.side_effect = delete
+
+        self.assertEqual(flush_index_queue(), 2)
+
+        self.assertEqual(self.bulk_index.call_args[0][0], [document('course:A')])
+        self.assertFalse(EdxOrgIndexOperation.objects.exists())
+        self.assertFalse(self.schedule.called)
+
+    @override_settings(EDX_ENTERPRISE_INDEX_QUEUE_MAX_ATTEMPTS=2)
+    def test_gives_up_after_max_attempts(self):
+        EdxOrgIndexOperation.objects.create(
+            course_id='course:A', action=EdxOrgIndexOperation.ACTION_DELETE, attempts=1)
+        self.delete.side_effect = requests.ConnectionError("refused")
+
+        flush_index_queue()
+
+        self.assertFalse(EdxOrgIndexOperation.objects.exists())
+        self.assertFalse(self.schedule.called)
+
+    def test_drains_operations_queued_while_releasing_lock(self):
+        drain_index_queue = indexing._drain_index_queue
+
+        def drain(*args):
+            result = drain_index_queue(*args)
+            if drain.calls == 0:
+                # queued by a flush that found the lock still taken after the last fetch
+                enqueue(EdxOrgIndexOperation.ACTION_DELETE, 'course:B')
+                self.assertEqual(flush_index_queue(), 0)
+            drain.calls += 1
+            return result
+        drain.calls = 0
+
+        enqueue(EdxOrgIndexOperation.ACTION_DELETE, 'course:A')
+        with mock.patch.object(indexing, '_drain_index_queue', side_effect=drain):
+            self.assertEqual(flush_index_queue(), 2)
+
+        self.assertEqual(drain.calls, 2)
+        self.assertFalse(EdxOrgIndexOperation.objects.exists())
+
+    @staticmethod
+    def fail_on_site(site, failing_site):
+        if site == failing_site:
+            raise requests.ConnectionError("refused")
+
+
+class SyncResumeTest(TestCase):
+
+    def setUp(self):
+        benchmark.InMemorySearchEngine.reset()
+        self.stub = benchmark.StubEnterpriseApi(courses=30, runs=1, page_size=10).start()
+        self.addCleanup(self.stub.stop)
+        settings_override = override_settings(
+            EDX_ENTERPRISE_API_MAX_RETRIES=0, EDX_ENTERPRISE_SYNC_CHECKPOINT_PAGES=1, **self.stub.settings())
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        create_course('Gone')
+
+    def failing_sync(self, failing_page):
+        edx_courses = EdxorgCourses()
+        iter_edx_courses_pages = edx_courses.iter_edx_courses_pages
+
+        def iter_pages(catalog_uuid, url=None):
+            for number, page in enumerate(iter_edx_courses_pages(catalog_uuid, url), 1):
+                if number == failing_page:
+                    raise requests.ConnectionError("reset")
+                yield page
+
+        edx_courses.iter_edx_courses_pages = iter_pages
+        return edx_courses
+
+    def test_resume_continues_from_checkpoint(self):
+        self.failing_sync(failing_page=2).set_edxorg_courses()
+
+        sync_run = EdxOrgSyncRun.objects.get()
+        self.assertEqual(sync_run.status, EdxOrgSyncRun.STATUS_FAILED)
+        self.assertEqual(len(sync_run.get_processed_course_ids()), 10)
+        self.assertTrue(EdxOrgCourse.objects.get(course_id='course:TestX+Gone').is_active)
+
+        self.stub.calls.clear()
+        summary = EdxorgCourses().set_edxorg_courses(resume=True)
+
+        self.assertEqual(self.stub.calls['course_pages'], 2)
+        self.assertEqual((summary['added'], summary['removed']), (20, 1))
+        self.assertEqual(EdxOrgSyncRun.objects.get().status, EdxOrgSyncRun.STATUS_COMPLETED)
+
+    def test_resume_keeps_courses_of_checkpointed_pages(self):
+        self.failing_sync(failing_page=2).set_edxorg_courses()
+        EdxorgCourses().set_edxorg_courses(resume=True)
+
+        active_course_ids = set(EdxOrgCourse.objects.filter(is_active=True).values_list('course_id', flat=True))
+        self.assertEqual(len(active_course_ids), 30)
+        self.assertNotIn('course:TestX+Gone', active_course_ids)
+        self.assertEqual(len(EdxOrgSyncRun.objects.get().get_processed_course_ids()), 30)
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        benchmark.InMemorySearchEngine.reset()
+        self.stub = benchmark.StubEnterpriseApi(courses=15, runs=1, page_size=10).start()
+        self.addCleanup(self.stub.stop)
+        settings_override = override_settings(**self.stub.settings())
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        create_course('Gone')
+
+    def write_snapshot(self, course_count):
+        with SnapshotWriter(self.path, ['catalog']) as snapshot:
+            for index in range(course_count):
+                snapshot.write('catalog', self.stub.course(index), None)
+        return snapshot.manifest
+
+    def update_manifest(self, **values):
+        manifest_path = os.path.join(self.path, SNAPSHOT_MANIFEST_FILE)
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest.update(values)
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+
+    def test_export_import_round_trip(self):
+        manifest = EdxorgCourses().export_snapshot(self.path)
+        self.assertEqual(manifest['course_count'], 15)
+        self.assertFalse(EdxOrgCourse.objects.filter(course_id__startswith='course:BenchX').exists())
+
+        self.stub.calls.clear()
+        summary = EdxorgCourses().import_snapshot(self.path)
+
+        self.assertEqual((summary['added'], summary['removed']), (15, 1))
+        self.assertEqual(EdxOrgCourse.objects.filter(is_active=True).count(), 15)
+        self.assertEqual(EdxOrgCourse.objects.get(course_id='course:BenchX+C0').course_marketing_url,
+                         'https://www.edx.org/course/BenchX+C0')
+        self.assertEqual(self.stub.calls['course_pages'] + self.stub.calls['course_detail'], 0)
+
+        summary = EdxorgCourses().import_snapshot(self.path, incremental=True)
+        self.assertEqual((summary['added'], summary['changed'], summary['unchanged']), (0, 0, 15))
+
+    def test_refuses_snapshot_missing_courses_of_its_manifest(self):
+        manifest = self.write_snapshot(2)
+        self.update_manifest(course_count=manifest['course_count'] + 1)
+
+        with self.assertRaises(SnapshotError):
+            EdxorgCourses().import_snapshot(self.path)
+        self.assertTrue(EdxOrgCourse.objects.get(course_id='course:TestX+Gone').is_active)
+
+    def test_refuses_snapshot_with_checksum_mismatch(self):
+        self.write_snapshot(2)
+        with open(os.path.join(self.path, SNAPSHOT_DATA_FILE), 'ab') as data_file:
+            data_file.write(b'truncated')
+
+        with self.assertRaises(SnapshotError):
+            EdxorgCourses().import_snapshot(self.path)
+        self.assertEqual(EdxOrgCourse.objects.count(), 1)
+
+    def test_refuses_unfinished_export(self):
+        with self.assertRaises(RuntimeError):
+            with SnapshotWriter(self.path) as snapshot:
+                snapshot.write('catalog', self.stub.course(0), None)
+                raise RuntimeError("crawl failed")
+
+        with self.assertRaises(SnapshotError):
+            EdxorgCourses().import_snapshot(self.path)
@@ -0,0 +1,228 @@
+"""In-process typeahead index over active edx.org courses.
+
+Course title, number, key and subjects are normalized with unidecode, split into tokens and kept
+in a sorted token list (prefix lookups by bisection) plus a trigram table of the tokens, used to
+correct query terms when no course matches every query prefix, e.g. on typos. Queries touch neither the database nor ElasticSearch.
+
+Each worker process builds one index per site catalog on first use and rebuilds it lazily when
+EdxOrgCourse.get_last_modified of the site moves, checking at most every
+EDX_ENTERPRISE_TYPEAHEAD_CHECK_INTERVAL seconds (60).
+"""
+import bisect
+import heapq
+import json
+import logging
+import re
+import threading
+import time
+
+from collections import Counter
+
+import unidecode
+
+from django.conf import settings
+from django.urls import reverse
+
+from openedx.features.edx_enterprise_api.models import EdxOrgCourse
+from openedx.features.edx_enterprise_api.sites import DEFAULT_SITE
+
+log = logging.getLogger(__name__)
+
+_NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+
+_indexes = {}
+_index_lock = threading.Lock()
+
+
+def normalize(text):
+    """Lowercase ASCII transliteration of text with runs of other characters collapsed to one space"""
+    return _NON_ALPHANUMERIC.sub(' ', unidecode.unidecode(u'{}'.format(text or '')).lower()).strip()
+
+
+def get_trigrams(normalized_text):
+    # a single space of padding; a lone first letter would tie a term to every token starting with it
+    padded = ' {} '.format(normalized_text)
+    return set(padded[index:index + 3] for index in range(len(padded) - 2))
+
+
+def get_subject_names(course_details):
+    """Subject names of a stored edx.org course, which lists them as names or as dicts with a name"""
+    names = []
+    for subject in course_details.get('subjects') or []:
+        name = subject.get('name') if isinstance(subject, dict) else subject
+        if name:
+            names.append(name)
+    return names
+
+
+class CourseTypeaheadIndex(object):
+    """Immutable prefix index of (course_id, title, number, subjects, about_url) entries
+
+    Courses are stored sorted by normalized title, so positions double as the alphabetical rank
+    and every postings list is sorted. Postings of one and two character prefixes are precomputed;
+    longer prefixes merge the postings of the few tokens sharing them.
+    """
+
+    def __init__(self, courses, version=None):
+        self.version = version
+        self.checked_at = 0
+        entries = sorted(
+            (normalize(title), course_id, title, number, subjects, about_url)
+            for course_id, title, number, subjects, about_url in courses)
+        self.courses = []
+        self.sort_keys = []
+        # ' token token ...' per course, so ' ' + prefix in text tests for a token starting with prefix
+        self.texts = []
+        postings = {}
+        short_prefix_postings = {}
+
+        for position, (normalized_title, course_id, title, number, subjects, about_url) in enumerate(entries):
+            self.courses.append({'course_id': course_id, 'title': title, 'number': number, 'url': about_url})
+            self.sort_keys.append(normalized_title)
+            tokens = set(' '.join(
+                [normalized_title, normalize(number), normalize(course_id)] + [normalize(name) for name in subjects]
+            ).split())
+            self.texts.append(' ' + ' '.join(sorted(tokens)))
+            for token in tokens:
+                postings.setdefault(token, []).append(position)
+            for prefix in set(token[:length] for token in tokens for length in (1, 2)):
+                short_prefix_postings.setdefault(prefix, []).append(position)
+
+        self.tokens = sorted(postings)
+        self.postings = [tuple(postings[token]) for token in self.tokens]
+        self.short_prefix_postings = dict(
+            (prefix, tuple(positions)) for prefix, positions in short_prefix_postings.items())
+        token_trigram_postings = {}
+        for token_index, token in enumerate(self.tokens):
+            for trigram in get_trigrams(token):
+                token_trigram_postings.setdefault(trigram, []).append(token_index)
+        self.token_trigram_postings = dict(
+            (trigram, tuple(token_indexes)) for trigram, token_indexes in token_trigram_postings.items())
+
+    def __len__(self):
+        return len(self.courses)
+
+    def get_prefix_postings(self, prefix):
+        """Sorted postings lists whose union holds the courses having a token starting with prefix"""
+        if len(prefix) <= 2:
+            return [self.short_prefix_postings.get(prefix, ())]
+        start = bisect.bisect_left(self.tokens, prefix)
+        # '{' sorts right after 'z', the last character tokens are made of
+        end = bisect.bisect_left(self.tokens, prefix + '{', start)
+        return self.postings[start:end]
+
+    def get_similar_token(self, term, min_similarity):
+        """Indexed token sharing the most trigrams with term, None below min_similarity
+
+        Similarity is the share of trigrams in common out of the larger trigram set of the two;
+        ties go to the token of more courses.
+        """
+        term_trigrams = get_trigrams(term)
+        shared = Counter()
+        for trigram in term_trigrams:
+            shared.update(self.token_trigram_postings.get(trigram, ()))
+        best_token, best_key = None, (min_similarity, 0)
+        for token_index, count in shared.items():
+            token = self.tokens[token_index]
+            key = (float(count) / max(len(term_trigrams), len(token)), len(self.postings[token_index]))
+            if key >= best_key:
+                best_token, best_key = token, key
+        return best_token
+
+    def get_matches(self, terms, limit):
+        """Positions of up to limit courses having a token starting with each of terms, best first"""
+        normalized_query = ' '.join(terms)
+        # titles starting with the query form one range of the sorted titles
+        start = bisect.bisect_left(self.sort_keys, normalized_query)
+        end = start
+        while end < len(self.sort_keys) and end - start < limit and self.sort_keys[end].startswith(normalized_query):
+            end += 1
+        positions = list(range(start, end))
+        if len(positions) >= limit:
+            return positions
+
+        # walk the rarest term's courses in rank order, checking the other terms on each course's text
+        rarest_postings = min(
+            (self.get_prefix_postings(term) for term in terms),
+            key=lambda postings: sum(len(term_positions) for term_positions in postings))
+        prefixes = [' ' + term for term in terms]
+        title_matches = set(positions)
+        previous = None
+        for position in heapq.merge(*rarest_postings):
+            if position == previous or position in title_matches:
+                continue
+            previous = position
+            text = self.texts[position]
+            if all(prefix in text for prefix in prefixes):
+                positions.append(position)
+                if len(positions) >= limit:
+                    break
+        return positions
+
+    def search(self, query, limit=10):
+        """Return up to limit courses matching every term of query as a token prefix, best first
+
+        Titles starting with the query rank first, then alphabetical order. When nothing matches,
+        terms no course matches are replaced by their most similar indexed token, so small typos
+        still find the course.
+        """
+        terms = normalize(query).split()
+        if not terms or limit <= 0:
+            return []
+
+        positions = self.get_matches(terms, limit)
+        if not positions:
+            min_similarity = getattr(settings, 'EDX_ENTERPRISE_TYPEAHEAD_MIN_SIMILARITY', 0.3)
+            corrected_terms = [
+                term if any(self.get_prefix_postings(term)) else self.get_similar_token(term, min_similarity)
+                for term in terms
+            ]
+            if None not in corrected_terms and corrected_terms != terms:
+                positions = self.get_matches(corrected_terms, limit)
+        return [self.courses[position] for position in positions]
+
+
+def build_typeahead_index(version=None, site=DEFAULT_SITE):
+    """Build CourseTypeaheadIndex from active EdxOrgCourse rows of site's catalog"""
+    started = time.time()
+    courses = []
+    rows = EdxOrgCourse.objects.filter(site=site, is_active=True).values_list(
+        'course_id', 'course_title', 'course_number', 'course_details_json')
+    for course_id, course_title, course_number, course_details_json in rows.iterator():
+        try:
+            subjects = get_subject_names(json.loads(course_details_json))
+        except (ValueError, AttributeError):
+            subjects = []
+        about_url = reverse('edxorg_course_about', kwargs={'course_id': course_id})
+        courses.append((course_id, course_title, course_number, subjects, about_url))
+    index = CourseTypeaheadIndex(courses, version)
+    log.info(
+        "Built edx.org course typeahead index of %s courses%s in %.3fs",
+        len(index), " of {}".format(site) if site else "", time.time() - started)
+    return index
+
+
+def get_typeahead_index(site=DEFAULT_SITE):
+    """Return this process' CourseTypeaheadIndex of site, rebuilding it when courses changed since it was built
+
+    While one thread rebuilds, other threads keep answering from the previous index.
+    """
+    index = _indexes.get(site)
+    check_interval = getattr(settings, 'EDX_ENTERPRISE_TYPEAHEAD_CHECK_INTERVAL', 60)
+    if index is not None and time.time() - index.checked_at < check_interval:
+        return index
+
+    if not _index_lock.acquire(index is None):
+        return index
+    try:
+        index = _indexes.get(site)
+        if index is not None and time.time() - index.checked_at < check_interval:
+            return index
+        version = EdxOrgCourse.get_last_modified(site)
+        if index is None or index.version != version:
+            index = build_typeahead_index(version, site)
+        index.checked_at = time.time()
+        _indexes[site] = index
+        return index
+    finally:
+        _index_lock.release()
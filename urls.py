@@ -10,4 +10,16 @@ urlpatterns = [
         name='edxorg_course_about',
     ),
 
+    url(
+        r'^api/edx_enterprise/v1/courses/$',
+        views.EdxorgCourseList.as_view(),
+        name='edxorg_course_list',
+    ),
+
+    url(
+        r'^api/edx_enterprise/v1/courses/typeahead/$',
+        views.EdxorgCourseTypeahead.as_view(),
+        name='edxorg_course_typeahead',
+    ),
+
 ]
@@ -1,36 +1,110 @@
-import ast
 import os
 import json
+import base64
+import calendar
+import hashlib
 import datetime
-import requests
 import logging
 import unidecode
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from django.views import View
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
+from django.core.cache import cache
 from django.views.decorators.csrf import ensure_csrf_cookie
-from django.shortcuts import get_object_or_404, redirect
+from django.shortcuts import redirect
 from django.urls import reverse
 from django.http import Http404
 from django.contrib.admin.views.decorators import staff_member_required
 from django.utils.decorators import method_decorator
 from django.core.exceptions import ObjectDoesNotExist, FieldError, FieldDoesNotExist
+from django.db import transaction
+from django.db.models import Q
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, quote_etag
 
 from edxmako.shortcuts import render_to_response, render_to_string
 from util.json_request import JsonResponse
 from util.cache import cache_if_anonymous
 
-from search.search_engine_base import SearchEngine
 from openedx.core.djangoapps.site_configuration import helpers as configuration_helpers
-from openedx.features.edx_enterprise_api.helpers import delete_edxorg_courses_from_search
-from openedx.features.edx_enterprise_api.models import EdxOrgCourse
+from openedx.features.edx_enterprise_api.api_client import EnterpriseApiClient
+from openedx.features.edx_enterprise_api.helpers import (
+    build_course_info,
+    get_content_hash,
+    get_course_runs_modified,
+    get_default_card_image_url,
+    interleave,
+    select_course_run,
+)
+from openedx.features.edx_enterprise_api.indexing import (
+    INDEX_QUEUE_LOCK_CACHE_KEY,
+    bulk_index_course_infos,
+    flush_index_queue,
+    rebuild_course_discovery_index,
+)
+from openedx.features.edx_enterprise_api.images import CourseImageCache, is_course_image_cache_enabled
+from openedx.features.edx_enterprise_api.instrumentation import SyncMetrics
+from openedx.features.edx_enterprise_api.snapshot import (
+    SnapshotError,
+    SnapshotWriter,
+    iter_snapshot_batches,
+    read_snapshot_manifest,
+)
+from openedx.features.edx_enterprise_api.sites import (
+    DEFAULT_SITE,
+    check_site_org_name,
+    get_org_name,
+    get_request_site,
+    get_site_setting,
+)
+from openedx.features.edx_enterprise_api.typeahead import get_typeahead_index
+from openedx.features.edx_enterprise_api.models import (
+    PAYLOAD_FIELDS,
+    EdxOrgCourse,
+    EdxOrgIndexOperation,
+    EdxOrgSyncRun,
+    get_changed_fields,
+    get_site_course_cache_key,
+)
+
+COURSE_ABOUT_HTML_CACHE_KEY = 'edx_enterprise_api.course_about_html.{}'
+# columns clients may select from the course list endpoint; none of the large text columns
+COURSE_SUMMARY_FIELDS = (
+    'course_id', 'course_title', 'course_number', 'course_image', 'course_marketing_url',
+    'course_enrollment_url', 'is_active', 'modified')
+SYNC_LOCK_CACHE_KEY = 'edx_enterprise_api.sync_lock'
 
 log = logging.getLogger(__name__)
 
 
+def get_sync_lock_cache_key(site=DEFAULT_SITE):
+    """Cache key of the lock held while site's catalog is synced; sites sync independently"""
+    return '{}.{}'.format(SYNC_LOCK_CACHE_KEY, site) if site else SYNC_LOCK_CACHE_KEY
+
+
+class SyncAlreadyRunning(Exception):
+    """Raised when set_edxorg_courses is started while another sync holds the lock"""
+
+
 class EdxorgCourses(object):
-    """ Fetch edx.org courses and save courses information into Database."""
+    """ Fetch edx.org courses and save courses information into Database.
+
+        Works on the catalog of site, with the enterprise credentials and catalogs configured for it.
+        Raises ImproperlyConfigured when site has no EDX_ENTERPRISE_ORG_NAME of its own.
+    """
+
+    def __init__(self, client=None, site=DEFAULT_SITE):
+        check_site_org_name(site)
+        self.site = site
+        self.metrics = client.metrics if client else SyncMetrics()
+        self.client = client or EnterpriseApiClient(metrics=self.metrics, site=site)
+        self.sync_lock_cache_key = get_sync_lock_cache_key(site)
+        self._image_cache = None
 
     def get_access_token_detail(self):
         """ Call EDX_ENTERPRISE_ACCESS_TOKEN_API  using credentials and get access token details of edx.org.
@@ -50,26 +124,17 @@ class EdxorgCourses(object):
                         u'expires_in': 3600, u'scope': u'read write profile email'
                 }
 
+            Token detail is cached by EnterpriseApiClient until shortly before it expires.
         """
+        return self.client.get_access_token_detail()
 
-        url = settings.EDX_ENTERPRISE_ACCESS_TOKEN_API
-
-        data = {
-            'grant_type': "client_credentials",
-            'client_id': settings.EDX_ENTERPRISE_API_CLIENT_ID,
-            'client_secret': settings.EDX_ENTERPRISE_API_CLIENT_SECRET,
-            'token_type': "jwt"
-        }
-
-        return requests.request("POST", url, data=data)
-
-    def get_client_catalog_detail(self, access_token_detail):
-        """ Call EDX_ENTERPRISE_CLIENT_CATALOG_DETAIL_API and get catalog details of edx.org
+    def get_client_catalog_detail(self):
+        """ Call EDX_ENTERPRISE_CLIENT_CATALOG_DETAIL_API and return parsed catalog details of edx.org
 
                 Request method is "GET"
 
                 header =  {
-                        'authorization': access_token_detail.json().get('token_type')  access_token_detail.json().get('access_token'),
+                        'authorization': token_type access_token,
                         'accept': "application/json",
                         'cache-control': "no-cache",
                 }
@@ -90,30 +155,56 @@ class EdxorgCourses(object):
                         u'next': u''
                 }
         """
-        url = settings.EDX_ENTERPRISE_CLIENT_CATALOG_DETAIL_API
+        url = get_site_setting(self.site, 'EDX_ENTERPRISE_CLIENT_CATALOG_DETAIL_API')
 
-        headers = {
-            'authorization': "{} {}".format(
-                access_token_detail.json().get('token_type'),
-                access_token_detail.json().get('access_token')),
-            'accept': "application/json",
-            'cache-control': "no-cache",
-        }
+        response = self.client.get(url)
+        response.raise_for_status()
+        return response.json()
 
-        return requests.request("GET", url, headers=headers)
+    def get_catalog_uuids(self, client_catalog_detail):
+        """ Return UUIDs of enterprise catalogs to sync.
 
-    def get_edx_courses_detail(
-            self,
-            access_token_detail,
-            client_catalog_detail,
-            api_url=None,
-            response_list=[]):
-        """ Make API using EDX_ENTERPRISE_COURSE_DETAIL_API and client_catalog_detail's UUID,
-        Call API and get edx.org courses detail.
+            All catalogs of the enterprise are synced unless EDX_ENTERPRISE_CATALOG_UUIDS
+            lists a subset of them.
+        """
+        catalog_uuids = [catalog.get('uuid') for catalog in client_catalog_detail.get('results', [])]
+        configured_uuids = get_site_setting(self.site, 'EDX_ENTERPRISE_CATALOG_UUIDS')
+        if configured_uuids:
+            catalog_uuids = [catalog_uuid for catalog_uuid in catalog_uuids if catalog_uuid in configured_uuids]
+        return catalog_uuids
+
+    def iter_catalogs_courses_pages(self, catalog_uuids, catalog_checkpoints=None):
+        """ Fetch every catalog concurrently and yield (catalog_uuid, courses page, next page url) as pages arrive.
+
+            Number of catalogs fetched at once is taken from EDX_ENTERPRISE_CATALOG_WORKERS (default 4).
+            Each catalog downloads its next page while at most one of its pages waits for the consumer.
+
+            catalog_checkpoints maps catalog UUID to the page url to resume from, or None
+            for a catalog which is already done.
+        """
+        catalog_checkpoints = catalog_checkpoints or {}
+        return interleave(
+            [self.iter_catalog_courses_pages(catalog_uuid, catalog_checkpoints.get(catalog_uuid))
+             for catalog_uuid in catalog_uuids
+             if catalog_checkpoints.get(catalog_uuid, '') is not None],
+            getattr(settings, 'EDX_ENTERPRISE_CATALOG_WORKERS', 4))
+
+    def iter_catalog_courses_pages(self, catalog_uuid, url=None):
+        """ Yield (catalog_uuid, courses page, next page url) for every page of one catalog"""
+        for courses_page, next_url in self.iter_edx_courses_pages(catalog_uuid, url):
+            yield catalog_uuid, courses_page, next_url
+
+    def iter_edx_courses_pages(self, catalog_uuid, url=None):
+        """ Make API using EDX_ENTERPRISE_COURSE_DETAIL_API and catalog UUID,
+        Follow the 'next' links and yield (edx.org courses page, next page url) page by page,
+        starting from url when given.
+
+        Only the page being consumed is held in memory and each response body is parsed once.
+        Errors are not swallowed, so a failed page stops the sync before stale courses are removed.
 
         Request method is 'GET'
         header = {
-                'authorization': access_token_detail.json().get('token_type')  access_token_detail.json().get('access_token'),
+                'authorization': token_type access_token,
                 'accept': "application/json",
                 'cache-control': "no-cache"
                 }
@@ -175,91 +266,82 @@ class EdxorgCourses(object):
                     }
 
          """
-        try:
-            url = api_url if api_url else "{}{}".format(
-                settings.EDX_ENTERPRISE_COURSE_DETAIL_API,
-                client_catalog_detail.json().get('results')[0].get('uuid'))
-
-            headers = {
-                'authorization': "{} {}".format(
-                    access_token_detail.json().get('token_type'),
-                    access_token_detail.json().get('access_token')),
-                'accept': "application/json",
-                'cache-control': "no-cache"}
-
-            response = requests.request("GET", url, headers=headers)
-
-            # if access token detail has been expired, its call again for access
-            # token detail and get edx.org courses details
-            if response.status_code == 401:
-                if "expired" in response.json().get("detail", ""):
-                    access_token_detail = self.get_access_token_detail()
-                    self.get_edx_courses_detail(
-                        access_token_detail,
-                        client_catalog_detail,
-                        response.json().get(
-                            'next',
-                            url),
-                        response_list)
-
-            response_list.extend(response.json().get('results', []))
-            if response.json().get('next', ''):
-                self.get_edx_courses_detail(
-                    access_token_detail,
-                    client_catalog_detail,
-                    response.json().get(
-                        'next',
-                        ''),
-                    response_list)
-            return response_list
-        except (TypeError, IndexError) as error:
-            log.exception(error)
-        except Exception as e:
-            log.exception(e)
+        url = url or "{}{}".format(
+            get_site_setting(self.site, 'EDX_ENTERPRISE_COURSE_DETAIL_API'),
+            catalog_uuid)
+
+        while url:
+            with self.metrics.timer('catalog_page'):
+                response = self.client.get(url)
+                # fail the sync rather than stop paginating on an error body
+                response.raise_for_status()
+                response_json = response.json()
+            self.metrics.increment('bytes_downloaded', len(response.content))
+            url = response_json.get('next') or None
+            yield response_json.get('results', []), url
 
     def get_course_marketing_url(
             self,
             course_key,
-            access_token_detail,
-            client_catalog_detail):
+            catalog_uuid):
         """ Get brief details for edx.org course and return marketing url
             url = "" https://api.edx.org/enterprise/v1/enterprise-catalogs/{catalog_id}/course-runs/{course_run_ID}""
             Request method is 'GET'
             header = {
-                'authorization': access_token_detail.json().get('token_type') access_token_detail.json().get('access_token'),
+                'authorization': token_type access_token,
                 'accept': "application/json",
                 'cache-control': "no-cache"
                 }
         """
         try:
             url = "{}{}/courses/{}".format(
-                settings.EDX_ENTERPRISE_COURSE_DETAIL_API,
-                client_catalog_detail.json().get('results')[0]['uuid'],
+                get_site_setting(self.site, 'EDX_ENTERPRISE_COURSE_DETAIL_API'),
+                catalog_uuid,
                 course_key)
 
-            headers = {
-                'authorization': "{} {}".format(
-                    access_token_detail.json().get('token_type'),
-                    access_token_detail.json().get('access_token')),
-                'accept': "application/json",
-                'cache-control': "no-cache"}
-
-            response = requests.request("GET", url, headers=headers)
-
-            if response.status_code == 401:
-                if "expired" in response.json().get("detail", ""):
-                    access_token_detail = self.get_access_token_detail()
-                    self.get_course_marketing_url(
-                        course_key, access_token_detail, client_catalog_detail)
-
-            if response.json().get('course_runs'):
-                return response.json().get('course_runs')[0]['marketing_url']
+            with self.metrics.timer('marketing_url'):
+                response = self.client.get(url)
+                response.raise_for_status()
+                course_runs = response.json().get('course_runs')
+            self.metrics.increment('bytes_downloaded', len(response.content))
+            if course_runs:
+                return course_runs[0]['marketing_url']
             else:
                 return None
         except (TypeError, IndexError) as error:
-            log.exception(error)
+            log.exception("Marketing url lookup failed for %s: %s", course_key, error)
         except Exception as e:
-            log.exception(e)
+            log.exception("Marketing url lookup failed for %s: %s", course_key, e)
+
+    def get_course_marketing_urls(self, course_catalogs):
+        """ Fetch marketing urls in parallel and return {course_key: marketing_url}
+
+            course_catalogs maps each course_key to the UUID of the catalog it is looked up in.
+
+            Number of worker threads is taken from EDX_ENTERPRISE_MARKETING_URL_WORKERS (default 8).
+            A course whose lookup fails is logged on its own and mapped to None.
+        """
+        max_workers = getattr(settings, 'EDX_ENTERPRISE_MARKETING_URL_WORKERS', 8)
+        marketing_urls = {}
+        course_catalogs = dict(
+            (course_key, catalog_uuid) for course_key, catalog_uuid in course_catalogs.items() if course_key)
+        if not course_catalogs:
+            return marketing_urls
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {
+                executor.submit(
+                    self.get_course_marketing_url,
+                    course_key,
+                    catalog_uuid): course_key for course_key, catalog_uuid in course_catalogs.items()}
+            for future in as_completed(futures):
+                course_key = futures[future]
+                try:
+                    marketing_urls[course_key] = future.result()
+                except Exception as e:
+                    log.exception("Marketing url lookup failed for %s: %s", course_key, e)
+                    marketing_urls[course_key] = None
+        return marketing_urls
 
     def reindex_edxorg_courses(self, course_info):
         """Reindex edx.org courses in course discovery
@@ -279,183 +361,463 @@ class EdxorgCourses(object):
                                 }
 
         """
-        searcher = SearchEngine.get_search_engine("courseware_index")
+        self.bulk_reindex_edxorg_courses([course_info])
+
+    def bulk_reindex_edxorg_courses(self, course_infos, chunk_size=None):
+        """Reindex edx.org courses in course discovery with one bulk request per chunk
+
+        course_infos is a list of course_info documents as described in reindex_edxorg_courses.
+        Chunk size defaults to EDX_ENTERPRISE_INDEX_CHUNK_SIZE (500).
+        Returns set of document ids which could not be indexed.
+        """
+        return bulk_index_course_infos(course_infos, chunk_size, self.metrics)
+
+    def queue_index_operations(self, course_infos, inactive_course_ids, flush=True):
+        """Queue documents built by the sync and removals of courses found inactive, then flush the queue
 
-        if not searcher:
+        The sync process flushes the queue itself, so queued operations are durable before a
+        checkpoint and applied in bulk together with any admin edits queued meanwhile.
+        """
+        with transaction.atomic():
+            EdxOrgIndexOperation.objects.enqueue(
+                EdxOrgIndexOperation.ACTION_INDEX,
+                [course_info['course'] for course_info in course_infos],
+                dict((course_info['course'], course_info) for course_info in course_infos),
+                schedule=False,
+                site=self.site)
+            EdxOrgIndexOperation.objects.enqueue(
+                EdxOrgIndexOperation.ACTION_DELETE, inactive_course_ids, schedule=False, site=self.site)
+        if flush:
+            flush_index_queue(metrics=self.metrics)
+
+    @property
+    def image_cache(self):
+        if self._image_cache is None:
+            self._image_cache = CourseImageCache(session=self.client.session, metrics=self.metrics)
+        return self._image_cache
+
+    def cache_course_images(self, courses_details, download=True):
+        """Point course_image of (course, course_details) pairs at local variants of their card images
+
+        Only with EDX_ENTERPRISE_COURSE_IMAGE_CACHE. Images not cached yet are downloaded; cached
+        images are requested again only for courses whose stored content hash changed. With
+        download=False only images cached earlier are used. A course whose image could not be
+        cached keeps the remote url.
+        """
+        if not is_course_image_cache_enabled():
+            return
+        courses_details = [
+            (course.get('card_image_url'), course_details) for course, course_details in courses_details
+            if course.get('card_image_url')]
+        if not courses_details:
             return
+
+        source_urls = [source_url for source_url, course_details in courses_details]
+        if download:
+            stored_hashes = dict(EdxOrgCourse.objects.filter(
+                site=self.site,
+                course_id__in=[course_details['course_id'] for source_url, course_details in courses_details]
+            ).values_list('course_id', 'content_hash'))
+            revalidate_urls = set(
+                source_url for source_url, course_details in courses_details
+                if stored_hashes.get(course_details['course_id']) != course_details['content_hash'])
+            local_urls = self.image_cache.cache_images(source_urls, revalidate_urls)
+        else:
+            local_urls = self.image_cache.get_cached_urls(source_urls)
+
+        for source_url, course_details in courses_details:
+            if source_url in local_urls:
+                course_details['course_image'] = local_urls[source_url]
+
+    def get_course_details(self, course, course_marketing_url, default_card_image_url):
+        """Map one edx.org course to EdxOrgCourse field values"""
+        course_key = course.get('key')
+        course_id = course.get('aggregation_key', '')
+        card_image_url = course.get('card_image_url') if course.get(
+            'card_image_url') else default_card_image_url
+        course_details_json = json.dumps(course, sort_keys=True)
+        course_details = {
+            "course_id": course_id,
+            "course_title": course.get('title'),
+            "course_number": course_key,
+            "course_image": card_image_url,
+            "short_description": course.get(
+                'short_description',
+                ''),
+            "full_description": course.get(
+                'full_description',
+                ''),
+            "course_marketing_url": course_marketing_url,
+            "course_enrollment_url": course.get(
+                'enrollment_url',
+                ''),
+            "course_details_json": course_details_json,
+            "content_hash": get_content_hash(course_details_json),
+            "course_runs_modified": get_course_runs_modified(course),
+            "is_active": True if course.get('course_runs') else False}
+        return course_details
+
+    def get_unchanged_course_ids(self, courses_details):
+        """Return ids of courses whose stored content hash, course runs modified time and active flag match
+
+        Courses without a stored marketing url are reported as changed so their lookup is retried.
+        """
+        stored_courses = EdxOrgCourse.objects.filter(
+            site=self.site,
+            course_id__in=[course_details['course_id'] for course_details in courses_details]
+        ).values_list('course_id', 'content_hash', 'course_runs_modified', 'is_active', 'course_marketing_url')
+        stored_state = {
+            course_id: (content_hash, course_runs_modified, is_active)
+            for course_id, content_hash, course_runs_modified, is_active, course_marketing_url in stored_courses
+            if course_marketing_url}
+        return set(
+            course_details['course_id'] for course_details in courses_details
+            if stored_state.get(course_details['course_id']) == (
+                course_details['content_hash'],
+                course_details['course_runs_modified'],
+                course_details['is_active']))
+
+    def get_course_info(self, course, course_details, now):
+        """Build course discovery document for an active edx.org course, None if course is not active"""
+        course_id = course_details['course_id']
+        card_image_url = course_details['course_image']
+
+        # edx.org course has multiple start-date of course
+        # find nearest course start-date from today and consider it
+        # as course start-date
+        if course_details['is_active']:
+            return build_course_info(
+                course_id,
+                course.get("key", ""),
+                course.get("title", ""),
+                card_image_url,
+                select_course_run(course.get("course_runs"), now),
+                site=self.site,
+                org=get_org_name(self.site))
+
+    def set_edxorg_courses(self, incremental=False, resume=False, rebuild_index=False, replace_concrete_index=False):
+        """Fetch courses from edx.org and save course information to database
+
+        Catalog pages are consumed as they arrive; the next page is downloaded
+        in the background while the current one is saved and reindexed.
+
+        Every catalog of the enterprise is fetched concurrently; a course listed in several
+        catalogs is saved, looked up and reindexed only once.
+
+        With incremental=True courses whose content hash and course runs modified time
+        are unchanged skip the marketing url lookup, database write and reindex.
+
+        Progress is checkpointed in an EdxOrgSyncRun; resume=True continues the last
+        unfinished run from its checkpoint. Raises SyncAlreadyRunning when another sync of the site
+        holds the lock; other sites sync independently.
+
+        With rebuild_index=True course discovery is not updated course by course: once the
+        database is synced every active course, of every site, is written into a fresh index which
+        replaces the live one (see indexing.rebuild_course_discovery_index). Index queue flushes are
+        held off meanwhile; if the rebuild fails the operations queued by the sync are flushed instead.
+
+        Returns counts of added, changed, unchanged and removed courses.
+        """
+        lock_timeout = self.acquire_sync_lock()
+        if rebuild_index and not cache.add(INDEX_QUEUE_LOCK_CACHE_KEY, True, lock_timeout):
+            cache.delete(self.sync_lock_cache_key)
+            raise SyncAlreadyRunning("course discovery index queue is being flushed")
+
+        summary = self.get_empty_summary()
+        sync_run = None
         try:
-            searcher.index("course_info", [course_info])
-        except BaseException:
-            log.exception(
-                "Course discovery indexing error encountered, course discovery index may be out of date %s",
-                course_info.get(
-                    "id",
-                    ""),
-            )
-
-        log.info(
-            "Successfully added %s course to the course discovery index",
-            course_info.get("id", "")
-        )
-
-    def get_course_run(
-            self,
-            time_difference_list,
-            sec_difference_sort,
-            course_runs,
-            sec_difference_item,
-            now,
-            index_cnt=0):
-        """ Get working course_run object for course"""
-
-        _index = time_difference_list.index(sec_difference_item)
-        _run = course_runs[_index]
-        if _run.get('enrollment_end'):
-            enrollment_end = datetime.datetime.strptime(
-                _run.get('enrollment_end'), '%Y-%m-%dT%H:%M:%SZ')
-            if enrollment_end < now:
-                index_cnt += 1
-                try:
-                    sec_difference_item = sec_difference_sort[index_cnt][1]
-                    return self.get_course_run(time_difference_list,
-                                               sec_difference_sort,
-                                               course_runs,
-                                               sec_difference_item,
-                                               now,
-                                               index_cnt
-                                               )
-                except Exception as e:
-                    if "index out of range" in e.message:
-                        sec_difference_item = sec_difference_sort[0][1]
-                        _index = time_difference_list.index(
-                            sec_difference_item)
-                        return course_runs[_index]
-        return _run
-
-    def set_edxorg_courses(self):
-        """Fetch courses from edx.org and save course information to database"""
-        current_course_list = []
+            sync_run = EdxOrgSyncRun.start(incremental=incremental, resume=resume, site=self.site)
+            self.sync_catalogs(sync_run, summary, lock_timeout, rebuild_index)
+            if rebuild_index:
+                rebuild_course_discovery_index(self.metrics, replace_concrete_index=replace_concrete_index)
+            sync_run.finish(EdxOrgSyncRun.STATUS_COMPLETED)
+        except Exception as e:
+            log.exception(e)
+            if sync_run is not None:
+                sync_run.finish(EdxOrgSyncRun.STATUS_FAILED, error=str(e))
+        finally:
+            if rebuild_index:
+                cache.delete(INDEX_QUEUE_LOCK_CACHE_KEY)
+            cache.delete(self.sync_lock_cache_key)
+        if rebuild_index:
+            # admin edits made during the rebuild, or the sync's own operations if it failed
+            flush_index_queue(metrics=self.metrics)
+
+        self.report_summary(summary)
+        return summary
+
+    def acquire_sync_lock(self):
+        """Take the sync lock of the site, raising SyncAlreadyRunning while another run holds it
+
+        Returns the lock timeout, EDX_ENTERPRISE_SYNC_LOCK_TIMEOUT (6 hours); runs refresh the
+        lock at each checkpoint and delete it when they end.
+        """
+        lock_timeout = getattr(settings, 'EDX_ENTERPRISE_SYNC_LOCK_TIMEOUT', 6 * 60 * 60)
+        if not cache.add(self.sync_lock_cache_key, True, lock_timeout):
+            raise SyncAlreadyRunning("edx.org courses sync{} is already running".format(
+                " of {}".format(self.site) if self.site else ""))
+        return lock_timeout
+
+    @staticmethod
+    def get_empty_summary():
+        return OrderedDict((('added', 0), ('changed', 0), ('unchanged', 0), ('removed', 0)))
+
+    def report_summary(self, summary):
+        """Count summary into the run metrics, then log and export them"""
+        for name, count in summary.items():
+            self.metrics.increment('courses_{}'.format(name), count)
+        self.metrics.log_summary()
+        self.metrics.export()
+
+    def sync_catalogs(self, sync_run, summary, lock_timeout, rebuild_index=False):
+        """Sync catalog pages into database and course discovery, checkpointing progress into sync_run
+
+        With rebuild_index index operations are only queued; the caller rebuilds the index.
+        """
+        catalog_checkpoints = sync_run.get_catalog_checkpoints()
+        current_course_ids = set(sync_run.get_processed_course_ids())
+        pending_checkpoints = {}
+        pages_since_checkpoint = 0
+        course_infos, inactive_course_ids = [], []
+        index_chunk_size = getattr(settings, 'EDX_ENTERPRISE_INDEX_CHUNK_SIZE', 500)
+        checkpoint_pages = getattr(settings, 'EDX_ENTERPRISE_SYNC_CHECKPOINT_PAGES', 10)
         now = datetime.datetime.now()
-        default_card_image_url = "{}/static/edx_enterprise_api/images/course_default_image.jpeg".format(
-            settings.LMS_ROOT_URL)
-        try:
-            access_token_detail = self.get_access_token_detail()
-            client_catalog_detail = self.get_client_catalog_detail(
-                access_token_detail)
-            edx_courses_detail = self.get_edx_courses_detail(
-                access_token_detail, client_catalog_detail)
-
-            for course in edx_courses_detail:
-                try:
-                    course_key = course.get('key')
-                    course_id = course.get('aggregation_key', '')
-                    card_image_url = course.get('card_image_url') if course.get(
-                        'card_image_url') else default_card_image_url
-                    course_details = {
-                        "course_id": course_id,
-                        "course_title": course.get('title'),
-                        "course_number": course_key,
-                        "course_image": card_image_url,
-                        "short_description": course.get(
-                            'short_description',
-                            ''),
-                        "full_description": course.get(
-                            'full_description',
-                            ''),
-                        "course_marketing_url": self.get_course_marketing_url(
-                            course_key,
-                            access_token_detail,
-                            client_catalog_detail),
-                        "course_enrollment_url": course.get(
-                            'enrollment_url',
-                            ''),
-                        "course_details_json": course,
-                        "is_active": True if course.get('course_runs') else False}
-
-                    edx_course, created = EdxOrgCourse.objects.update_or_create(
-                        course_id=course_id, defaults=course_details,)
-                    edx_course.save()
-
-                    # edx.org course has multiple start-date of course
-                    # find nearest course start-date from today and consider it
-                    # as course start-date
-                    if edx_course.is_active:
-                        try:
-                            time_difference_list = []
-                            for course_run in course.get("course_runs"):
-                                _start_date = datetime.datetime.strptime(
-                                    course_run.get('start') if course_run.get("start") else "2017-01-01T00:00:00Z",
-                                    '%Y-%m-%dT%H:%M:%SZ')
-                                time_difference_list.append(
-                                    (now - _start_date).total_seconds())
-                            all_sec_difference, sec_difference_sort = [
-                                (abs(time_difference), time_difference) for time_difference in time_difference_list], [
-                                (abs(time_difference), time_difference) for time_difference in time_difference_list]
-                            sec_difference_sort.sort()
-                            sec_difference_item = sec_difference_sort[0][1]
-                            course_run_obj = self.get_course_run(
-                                time_difference_list,
-                                sec_difference_sort,
-                                course.get("course_runs"),
-                                sec_difference_item,
-                                now)
-                        except Exception as e:
-                            course_run_obj = course.get("course_runs")[0]
-                            log.error(str(e))
-
-                        course_start = datetime.datetime.strptime(
-                            course_run_obj.get("start").split('T')[0]
-                            if course_run_obj.get("start") else "2017-01-01", '%Y-%m-%d').strftime('%b %d, %Y')
-
-                        enrollment_start = datetime.datetime.strptime(
-                            course_run_obj.get("enrollment_start").split('T')[0]
-                            if course_run_obj.get("enrollment_start") else "2017-01-01", '%Y-%m-%d').strftime('%b %d, %Y')
-
-                        # make json format for reindexing courses in
-                        # elasticsearch
-                        course_info = {
-                            'id': course_id,
-                            'course': course_id,
-                            'content': {
-                                'number': course.get("key", ""),
-                                'display_name': course.get("title", "")
-                            },
-                            'org': "edX Courses",
-                            'is_edx': True,
-                            'image_url': card_image_url,
-                            'start': course_start,
-                            'enrollment_start': enrollment_start,
-                        }
-                        self.reindex_edxorg_courses(course_info)
-                except (IndexError, TypeError, FieldDoesNotExist, FieldError) as error:
-                    log.exception(error)
-                except Exception as e:
-                    raise e
+        default_card_image_url = get_default_card_image_url()
+
+        catalog_uuids = self.get_catalog_uuids(self.get_client_catalog_detail())
+        edx_courses_pages = self.iter_catalogs_courses_pages(catalog_uuids, catalog_checkpoints)
+
+        for catalog_uuid, edx_courses_detail, next_url in edx_courses_pages:
+            courses_details = self.get_page_courses_details(
+                edx_courses_detail, current_course_ids, default_card_image_url)
+            page_course_count = len(courses_details)
+
+            if sync_run.incremental:
+                courses_details = self.exclude_unchanged_courses(courses_details)
+
+            marketing_urls = self.get_course_marketing_urls(
+                dict((course.get('key'), catalog_uuid) for course, course_details in courses_details))
+            for course, course_details in courses_details:
+                course_details['course_marketing_url'] = marketing_urls.get(course.get('key'))
+            self.cache_course_images(courses_details)
+
+            page_course_infos, page_inactive_course_ids = self.save_courses_details(
+                courses_details, page_course_count, summary, now)
+            course_infos.extend(page_course_infos)
+            inactive_course_ids.extend(page_inactive_course_ids)
+
+            # checkpoint only once the page is queued for indexing, so a resumed run never skips index documents
+            pending_checkpoints[catalog_uuid] = next_url
+            pages_since_checkpoint += 1
+            if len(course_infos) >= index_chunk_size or pages_since_checkpoint >= checkpoint_pages:
+                self.queue_index_operations(course_infos, inactive_course_ids, flush=not rebuild_index)
+                course_infos, inactive_course_ids = [], []
+                catalog_checkpoints.update(pending_checkpoints)
+                pending_checkpoints = {}
+                pages_since_checkpoint = 0
+                sync_run.checkpoint(catalog_checkpoints, current_course_ids)
+                cache.set(self.sync_lock_cache_key, True, lock_timeout)
+
+        self.queue_index_operations(course_infos, inactive_course_ids, flush=not rebuild_index)
+        catalog_checkpoints.update(pending_checkpoints)
+        sync_run.checkpoint(catalog_checkpoints, current_course_ids)
+
+        self.remove_stale_courses(current_course_ids, summary, rebuild_index)
+
+    def export_snapshot(self, path):
+        """Crawl the catalog like a sync and write it as a snapshot into directory path, without touching the database
+
+        Records carry the edx.org course and its looked up marketing url, so importing nodes
+        normalize them with their own settings and never call the API. Returns the manifest.
+        """
+        seen_course_ids = set()
+        default_card_image_url = get_default_card_image_url()
+        catalog_uuids = self.get_catalog_uuids(self.get_client_catalog_detail())
+
+        with SnapshotWriter(path, catalog_uuids) as snapshot:
+            for catalog_uuid, edx_courses_detail, next_url in self.iter_catalogs_courses_pages(catalog_uuids):
+                courses_details = self.get_page_courses_details(
+                    edx_courses_detail, seen_course_ids, default_card_image_url)
+                marketing_urls = self.get_course_marketing_urls(
+                    dict((course.get('key'), catalog_uuid) for course, course_details in courses_details))
+                for course, course_details in courses_details:
+                    snapshot.write(catalog_uuid, course, marketing_urls.get(course.get('key')))
+        log.info("Exported %s edx.org courses to %s", snapshot.course_count, path)
+        return snapshot.manifest
+
+    def import_snapshot(self, path, incremental=False):
+        """Load a snapshot written by export_snapshot into the database and course discovery
+
+        Records are streamed in EDX_ENTERPRISE_SYNC_BATCH_SIZE (500) batches through the same
+        upsert and index queue as a sync. Courses missing from the snapshot are deactivated only
+        after every record announced by the manifest was read. Holds the sync lock.
+
+        Returns counts of added, changed, unchanged and removed courses.
+        """
+        manifest = read_snapshot_manifest(path)
+        lock_timeout = self.acquire_sync_lock()
 
-            # delete inactive or end courses from elasticsearch
+        summary = self.get_empty_summary()
+        batch_size = getattr(settings, 'EDX_ENTERPRISE_SYNC_BATCH_SIZE', 500)
+        now = datetime.datetime.now()
+        default_card_image_url = get_default_card_image_url()
+        current_course_ids = set()
+        record_count = 0
+        try:
+            for records in iter_snapshot_batches(path, manifest, batch_size):
+                record_count += len(records)
+                courses_details = []
+                for record in records:
+                    course = record['course']
+                    current_course_ids.add(course.get('aggregation_key', ''))
+                    try:
+                        courses_details.append((course, self.get_course_details(
+                            course, record.get('course_marketing_url'), default_card_image_url)))
+                    except (IndexError, TypeError, FieldDoesNotExist, FieldError) as error:
+                        log.exception(error)
+                page_course_count = len(courses_details)
+                if incremental:
+                    courses_details = self.exclude_unchanged_courses(courses_details)
+                self.cache_course_images(courses_details)
+                course_infos, inactive_course_ids = self.save_courses_details(
+                    courses_details, page_course_count, summary, now)
+                self.queue_index_operations(course_infos, inactive_course_ids)
+                cache.set(self.sync_lock_cache_key, True, lock_timeout)
+
+            if record_count != manifest['course_count']:
+                raise SnapshotError("Snapshot holds {} courses, its manifest announces {}".format(
+                    record_count, manifest['course_count']))
+            self.remove_stale_courses(current_course_ids, summary)
+        finally:
+            cache.delete(self.sync_lock_cache_key)
+
+        self.report_summary(summary)
+        return summary
+
+    def get_page_courses_details(self, edx_courses_detail, seen_course_ids, default_card_image_url):
+        """Map courses of one catalog page to (course, course_details) pairs, skipping ids in seen_course_ids
+
+        Ids of the mapped courses are added to seen_course_ids.
+        """
+        courses_details = []
+        for course in edx_courses_detail:
+            # course already synced from another catalog
+            if course.get('aggregation_key', '') in seen_course_ids:
+                continue
+            seen_course_ids.add(course.get('aggregation_key', ''))
+            try:
+                courses_details.append((course, self.get_course_details(
+                    course,
+                    None,
+                    default_card_image_url)))
+            except (IndexError, TypeError, FieldDoesNotExist, FieldError) as error:
+                log.exception(error)
+        return courses_details
+
+    def exclude_unchanged_courses(self, courses_details):
+        """Drop (course, course_details) pairs whose stored row is unchanged, see get_unchanged_course_ids"""
+        unchanged_course_ids = self.get_unchanged_course_ids(
+            [course_details for course, course_details in courses_details])
+        return [
+            (course, course_details) for course, course_details in courses_details
+            if course_details['course_id'] not in unchanged_course_ids]
+
+    def save_courses_details(self, courses_details, page_course_count, summary, now):
+        """Upsert one page of (course, course_details) pairs and count them into summary
+
+        Returns course discovery documents of the page and ids of courses which became inactive.
+        """
+        with self.metrics.timer('db_upsert'):
+            created_course_ids, updated_course_ids = EdxOrgCourse.objects.bulk_upsert(
+                [course_details for course, course_details in courses_details], site=self.site)
+        summary['added'] += len(created_course_ids)
+        summary['changed'] += len(updated_course_ids)
+        summary['unchanged'] += page_course_count - len(created_course_ids) - len(updated_course_ids)
+
+        course_infos, inactive_course_ids = [], []
+        updated_course_ids = set(updated_course_ids)
+        for course, course_details in courses_details:
             try:
-                aggregation_key_list = [element['aggregation_key']
-                                        for element in edx_courses_detail]
-                edxorg_courses_list = EdxOrgCourse.objects.all().values_list('course_id', flat=True)
-                difference_list = set(edxorg_courses_list) - \
-                    set(aggregation_key_list)
-                for course_key in difference_list:
-                    edxorg_courses_obj = EdxOrgCourse.objects.get(
-                        course_id=course_key)
-                    edxorg_courses_obj.is_active = False
-                    edxorg_courses_obj.save()
-                    delete_edxorg_courses_from_search(
-                        edxorg_courses_obj.course_id)
-
-            except EdxOrgCourse.ObjectDoesNotExist as e:
-                log.exception(e)
+                course_info = self.get_course_info(course, course_details, now)
+                if course_info:
+                    course_infos.append(course_info)
+                elif course_details['course_id'] in updated_course_ids:
+                    # course lost its last course run since the previous sync
+                    inactive_course_ids.append(course_details['course_id'])
+            except (IndexError, TypeError) as error:
+                log.exception(error)
+        return course_infos, inactive_course_ids
+
+    def remove_stale_courses(self, current_course_ids, summary, rebuild_index=False):
+        """Deactivate active courses of the site missing from current_course_ids and flush their removal"""
+        # delete inactive or end courses from elasticsearch
+        with self.metrics.timer('stale_cleanup'):
+            # rows already deactivated were removed from the index by an earlier run
+            edxorg_courses_list = EdxOrgCourse.objects.filter(
+                site=self.site, is_active=True).values_list('course_id', flat=True)
+            difference_list = set(edxorg_courses_list) - current_course_ids
+            if difference_list:
+                # queues their removal, applied by the flush below
+                EdxOrgCourse.objects.filter(site=self.site, course_id__in=difference_list).delete()
+        if not rebuild_index:
+            flush_index_queue(metrics=self.metrics)
+        summary['removed'] = len(difference_list)
+
+    def iter_catalog_changes(self):
+        """Fetch the catalog and yield the changes a sync would make, without writing anything
+
+        Existing rows are read once up front (payload columns deferred) and compared with the same
+        get_changed_fields used by the sync upsert. Marketing urls are not fetched, so they are
+        left out of the comparison. Yields dicts like
+            {'action': 'create' | 'update' | 'deactivate', 'course_id': ..., 'fields': [...],
+             'remove_from_index': bool}
+        """
+        existing_courses = dict(
+            (course.course_id, course)
+            for course in EdxOrgCourse.objects.filter(site=self.site).defer(*PAYLOAD_FIELDS).iterator())
+        seen_course_ids = set()
+        default_card_image_url = get_default_card_image_url()
+
+        catalog_uuids = self.get_catalog_uuids(self.get_client_catalog_detail())
+        for catalog_uuid, edx_courses_detail, next_url in self.iter_catalogs_courses_pages(catalog_uuids):
+            courses_details = self.get_page_courses_details(
+                edx_courses_detail, seen_course_ids, default_card_image_url)
+            # compare course_image with what the sync would store, without downloading anything
+            self.cache_course_images(courses_details, download=False)
+            for course, course_details in courses_details:
+                course_id = course_details['course_id']
+                del course_details['course_marketing_url']
+
+                existing_course = existing_courses.get(course_id)
+                if existing_course is None:
+                    yield {'action': 'create', 'course_id': course_id, 'fields': [], 'remove_from_index': False}
+                    continue
+                changed_fields = get_changed_fields(existing_course, course_details)
+                if changed_fields:
+                    yield {
+                        'action': 'update',
+                        'course_id': course_id,
+                        'fields': sorted(changed_fields),
+                        # the sync drops courses that lost their last course run from the index
+                        'remove_from_index': existing_course.is_active and not course_details['is_active'],
+                    }
 
-        except Exception as e:
-            log.exception(e)
+        for course_id, existing_course in existing_courses.items():
+            if existing_course.is_active and course_id not in seen_course_ids:
+                yield {
+                    'action': 'deactivate',
+                    'course_id': course_id,
+                    'fields': ['is_active'],
+                    'remove_from_index': True,
+                }
 
 
 class EdxorgCourseAbout(View):
-    """Render course about page of edx.org courses"""
+    """Render course about page of edx.org courses
+
+    Course section of the page is rendered once per site, course version and language
+    and served from cache to anonymous and logged-in users alike.
+    """
 
     @method_decorator(ensure_csrf_cookie)
     @method_decorator(cache_if_anonymous())
@@ -463,21 +825,21 @@ class EdxorgCourseAbout(View):
         """Pass edx.org course_id as Arg and Redirect to particular course about page"""
 
         try:
-            default_card_image_url = "{}/static/edx_enterprise_api/images/course_default_image.jpeg".format(
-                settings.LMS_ROOT_URL)
-            course_obj = get_object_or_404(EdxOrgCourse, course_id=course_id)
-            course_about_data = ast.literal_eval(
-                course_obj.course_details_json)
-            course_about_data.update(
-                {'course_number': course_obj.course_number,
-                 'org': 'edX Courses', 'enroll_url': course_obj.course_enrollment_url,
-                 'course_marketing_url': course_obj.course_marketing_url,
-                 'is_course_available': True if course_about_data['course_runs'] else False,
-                 }
-            )
-            if not course_about_data['card_image_url']:
-                course_about_data.update(
-                    {'card_image_url': default_card_image_url})
+            site = get_request_site()
+            course_about_data = EdxOrgCourse.get_cached_about_record(course_id, site)
+            language = getattr(request, 'LANGUAGE_CODE', settings.LANGUAGE_CODE)
+            cache_key = get_site_course_cache_key(
+                COURSE_ABOUT_HTML_CACHE_KEY, site, course_id, course_about_data['version'], language)
+            course_about_html = cache.get(cache_key)
+            if course_about_html is None:
+                course_about_html = render_to_string(
+                    'edx_enterprise_api/edxorg_course_about_content.html',
+                    course_about_data,
+                    request=request)
+                cache.set(
+                    cache_key,
+                    course_about_html,
+                    getattr(settings, 'EDX_ENTERPRISE_COURSE_ABOUT_CACHE_TIMEOUT', 86400))
 
         except Exception as e:
             log.exception(e)
@@ -485,4 +847,102 @@ class EdxorgCourseAbout(View):
 
         return render_to_response(
             'edx_enterprise_api/edxorg_course_about.html',
-            course_about_data)
+            {'title': course_about_data['title'], 'course_about_html': course_about_html})
+
+
+class EdxorgCourseList(View):
+    """Paginated JSON list of active edx.org course summaries of the request site's catalog
+
+    Query parameters:
+        fields: comma separated subset of COURSE_SUMMARY_FIELDS, all of them by default
+        page_size: courses per page, capped at EDX_ENTERPRISE_COURSE_LIST_MAX_PAGE_SIZE (500)
+        cursor: 'cursor' of the previous page; pages are ordered by modified, so polling with the
+            last cursor returns only courses changed since
+        include_inactive: 'true' to list deactivated courses too, so pollers see removals
+
+    ETag and Last-Modified follow the latest change written by a sync or the admin; a request
+    repeating If-None-Match or If-Modified-Since is answered 304 from that one lookup.
+    """
+
+    def get(self, request):
+        site = get_request_site()
+        last_modified = EdxOrgCourse.get_last_modified(site)
+        last_modified_value = last_modified.isoformat() if last_modified else ''
+        etag = quote_etag(hashlib.md5(
+            "{}{}?{}".format(site, last_modified_value, request.GET.urlencode()).encode('utf-8')).hexdigest())
+        last_modified_timestamp = calendar.timegm(last_modified.utctimetuple()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified_timestamp)
+        if response is None:
+            try:
+                response = JsonResponse(self.get_page(request, site))
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+
+        response['ETag'] = etag
+        if last_modified_timestamp is not None:
+            response['Last-Modified'] = http_date(last_modified_timestamp)
+        return response
+
+    def get_page(self, request, site=DEFAULT_SITE):
+        fields = [field for field in request.GET.get('fields', '').split(',') if field] or list(COURSE_SUMMARY_FIELDS)
+        unknown_fields = set(fields) - set(COURSE_SUMMARY_FIELDS)
+        if unknown_fields:
+            raise ValueError("Unknown fields: {}".format(", ".join(sorted(unknown_fields))))
+        max_page_size = getattr(settings, 'EDX_ENTERPRISE_COURSE_LIST_MAX_PAGE_SIZE', 500)
+        try:
+            page_size = min(max(int(request.GET.get('page_size', 100)), 1), max_page_size)
+        except ValueError:
+            raise ValueError("page_size must be a number")
+
+        courses = EdxOrgCourse.objects.filter(site=site)
+        if request.GET.get('include_inactive') != 'true':
+            courses = courses.filter(is_active=True)
+        if request.GET.get('cursor'):
+            cursor_modified, cursor_id = self.decode_cursor(request.GET['cursor'])
+            courses = courses.filter(Q(modified__gt=cursor_modified) | Q(modified=cursor_modified, id__gt=cursor_id))
+
+        rows = list(courses.order_by('modified', 'id').values('id', *set(fields) | set(['modified']))[:page_size])
+        results = [dict((field, row[field]) for field in fields) for row in rows]
+        cursor = self.encode_cursor(rows[-1]['modified'], rows[-1]['id']) if rows else request.GET.get('cursor')
+
+        next_url = None
+        if len(rows) == page_size:
+            query = request.GET.copy()
+            query['cursor'] = cursor
+            next_url = request.build_absolute_uri("{}?{}".format(request.path, query.urlencode()))
+        return {'results': results, 'cursor': cursor, 'next': next_url}
+
+    @staticmethod
+    def encode_cursor(modified, course_pk):
+        return base64.urlsafe_b64encode(
+            json.dumps([modified.isoformat(), course_pk]).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            modified, course_pk = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            modified = parse_datetime(modified)
+        except (TypeError, ValueError, UnicodeError):
+            modified = None
+        if modified is None:
+            raise ValueError("Invalid cursor")
+        return modified, int(course_pk)
+
+
+class EdxorgCourseTypeahead(View):
+    """JSON typeahead matches of the request site's active edx.org courses, from this process' CourseTypeaheadIndex
+
+    Query parameters:
+        q: text typed so far; every word must start a word of the course title, number, key or subjects
+        limit: courses returned, 10 by default, capped at EDX_ENTERPRISE_TYPEAHEAD_MAX_LIMIT (50)
+    """
+
+    def get(self, request):
+        max_limit = getattr(settings, 'EDX_ENTERPRISE_TYPEAHEAD_MAX_LIMIT', 50)
+        try:
+            limit = min(max(int(request.GET.get('limit', 10)), 1), max_limit)
+        except ValueError:
+            return JsonResponse({'error': "limit must be a number"}, status=400)
+        typeahead_index = get_typeahead_index(get_request_site())
+        return JsonResponse({'results': typeahead_index.search(request.GET.get('q', ''), limit)})